@@ -3,21 +3,35 @@ A2A Protocol Server for Clinical Trial Matching Agents
 Implements agent discovery and communication using A2A Protocol
 """
 
-import json
+import asyncio
+import logging
+import os
+import msgspec
+import orjson
 import uuid
+from contextlib import asynccontextmanager
+from types import MappingProxyType
 from typing import Dict, List, Any, Optional
-from fastapi import FastAPI, HTTPException
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from a2a_protocol.dataclass import Message, TextPart, Role, Task, TaskStatus
 from a2a_protocol.pydantic_v2 import Message as PydanticMessage, Part, TextPart as PydanticTextPart, Role as PydanticRole
 
-from agents.adk_agents import initialize_adk_agents
-from tracing.weave_logger import log_workflow_step, log_error
+from agents.registry import get_agents
+from services.cache import patient_fingerprint
+from services.document_ai import close_documentai_client
+from services.http_client import close_http_client
+from tasks import TASKS, cancel_workflow_task, schedule_finalize
+from tracing.weave_logger import capture_trace, finalize_session, log_workflow_step, log_error, start_trace
 
 # Agent registry for discovery
 AGENT_REGISTRY = {}
 
-class AgentInfo(BaseModel):
+# Accept the older "pdf_path:..." / "patient_data:..." text part messages
+A2A_LEGACY_TEXT_PARTS = os.getenv("A2A_LEGACY_TEXT_PARTS", "true").lower() in ("1", "true", "yes")
+
+class AgentInfo(msgspec.Struct):
     """Agent information for discovery"""
     agent_id: str
     name: str
@@ -26,36 +40,104 @@ class AgentInfo(BaseModel):
     endpoint: str
     status: str = "active"
 
-class A2ARequest(BaseModel):
+class A2ARequest(msgspec.Struct):
     """A2A Protocol request"""
     agent_id: str
     message: Dict[str, Any]
     task_id: Optional[str] = None
 
-class A2AResponse(BaseModel):
+class A2AResponse(msgspec.Struct, kw_only=True):
     """A2A Protocol response"""
     status: str
     message: Dict[str, Any]
     task_id: Optional[str] = None
     agent_id: str
 
+# Static agent discovery info, built once at import
+_AGENTS = MappingProxyType({
+    info.agent_id: msgspec.to_builtins(info) for info in (
+        # Document Processing Agent
+        AgentInfo(
+            agent_id="document_processing_agent",
+            name="Document Processing Agent",
+            description="Processes patient PDF documents using Google Document AI",
+            capabilities=["pdf_parsing", "data_extraction", "medical_document_processing"],
+            endpoint="/agents/document_processing_agent/message"
+        ),
+        # Clinical Trials Agent
+        AgentInfo(
+            agent_id="clinical_trials_agent",
+            name="Clinical Trials Agent",
+            description="Fetches relevant clinical trials from clinicaltrials.gov",
+            capabilities=["trial_search", "condition_matching", "eligibility_filtering"],
+            endpoint="/agents/clinical_trials_agent/message"
+        ),
+        # Eligibility Analysis Agent
+        AgentInfo(
+            agent_id="eligibility_analysis_agent",
+            name="Eligibility Analysis Agent",
+            description="Analyzes patient eligibility for clinical trials using AI",
+            capabilities=["eligibility_analysis", "ai_reasoning", "criteria_matching"],
+            endpoint="/agents/eligibility_analysis_agent/message"
+        ),
+        # Orchestrator Agent
+        AgentInfo(
+            agent_id="clinical_trial_orchestrator",
+            name="Clinical Trial Orchestrator",
+            description="Main orchestrator for clinical trial matching workflow",
+            capabilities=["workflow_orchestration", "agent_coordination", "result_aggregation"],
+            endpoint="/agents/clinical_trial_orchestrator/message"
+        )
+    )
+})
+_AGENT_LIST = tuple(_AGENTS.values())
+
+# Built once; decodes and validates request bodies in a single pass
+A2A_REQUEST_DECODER = msgspec.json.Decoder(A2ARequest)
+
+async def decode_a2a_request(request: Request) -> A2ARequest:
+    """FastAPI dependency that decodes an A2A request body with msgspec"""
+    try:
+        return A2A_REQUEST_DECODER.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+class PatientPayload(BaseModel):
+    """Structured data carried by an A2A message"""
+    pdf_path: Optional[str] = None
+    patient_data: Optional[Dict[str, Any]] = None
+    trials: Optional[List[Dict[str, Any]]] = None
+
 class A2AProtocolServer:
     """A2A Protocol Server for agent communication"""
     
-    def __init__(self):
-        self.app = FastAPI(title="Clinical Trial Matching A2A Server")
-        self.agents = initialize_adk_agents()
-        self.tasks = {}  # Task tracking
+    def __init__(self, agents: Optional[Dict[str, Any]] = None):
+        self.app = FastAPI(
+            title="Clinical Trial Matching A2A Server",
+            lifespan=self.lifespan,
+            default_response_class=ORJSONResponse
+        )
+        self.agents = agents  # Shared ADK agents, injected by the host app
+        self.tasks = TASKS  # Task tracking, shared with background workflow tasks
         self.setup_routes()
         self.register_agents()
     
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        """Create agents when running standalone (mounted sub-apps don't get lifespan events)"""
+        if self.agents is None:
+            self.agents = get_agents()
+        yield
+        await close_http_client()
+        close_documentai_client()
+    
     def setup_routes(self):
         """Setup FastAPI routes for A2A Protocol"""
         
         @self.app.get("/agents")
         async def list_agents():
             """List all available agents"""
-            return {"agents": list(AGENT_REGISTRY.values())}
+            return {"agents": _AGENT_LIST}
         
         @self.app.get("/agents/{agent_id}")
         async def get_agent_info(agent_id: str):
@@ -65,52 +147,53 @@ class A2AProtocolServer:
             return AGENT_REGISTRY[agent_id]
         
         @self.app.post("/agents/{agent_id}/message")
-        async def send_message(agent_id: str, request: A2ARequest):
+        async def send_message(agent_id: str, request: A2ARequest = Depends(decode_a2a_request)):
             """Send a message to a specific agent"""
             try:
                 if agent_id not in AGENT_REGISTRY:
                     raise HTTPException(status_code=404, detail="Agent not found")
                 
                 # Process message based on agent type
-                response_message = await self.process_agent_message(agent_id, request.message)
+                response_message = await self.process_agent_message(agent_id, request.message, request.task_id)
                 
-                return A2AResponse(
+                return msgspec.to_builtins(A2AResponse(
                     status="success",
                     message=response_message,
                     task_id=request.task_id,
                     agent_id=agent_id
-                )
+                ))
                 
+            except HTTPException:
+                raise
+            except asyncio.TimeoutError:
+                # Already logged with the message's trace
+                raise HTTPException(status_code=504, detail="upstream timeout")
             except Exception as e:
-                log_error("a2a_message_error", str(e), {"agent_id": agent_id, "request": request.dict()})
-                return A2AResponse(
+                log_error("a2a_message_error", str(e), message_log_context(agent_id, request.message, request.task_id))
+                return msgspec.to_builtins(A2AResponse(
                     status="error",
                     message={"error": str(e)},
                     task_id=request.task_id,
                     agent_id=agent_id
-                )
+                ))
         
         @self.app.post("/workflow/run")
-        async def run_workflow(pdf_path: str):
+        async def run_workflow(pdf_path: str, background_tasks: BackgroundTasks):
             """Run the complete clinical trial matching workflow"""
             try:
                 task_id = str(uuid.uuid4())
                 
-                # Create A2A message for orchestrator
-                message = {
-                    "role": "user",
-                    "parts": [{"type": "text", "text": f"pdf_path:{pdf_path}"}]
-                }
+                # Await the orchestrator directly instead of round-tripping through an A2A message
+                result = await self.agents["orchestrator"].run_full_workflow(pdf_path)
+                # Flush telemetry after the response has been sent
+                background_tasks.add_task(finalize_session, result, capture_trace())
                 
-                # Send to orchestrator
-                request = A2ARequest(
-                    agent_id="clinical_trial_orchestrator",
-                    message=message,
-                    task_id=task_id
-                )
-                
-                response = await self.send_message("clinical_trial_orchestrator", request)
-                return response
+                return msgspec.to_builtins(A2AResponse(
+                    status="error" if result.get("status") == "failed" else "success",
+                    message={"role": "agent", "parts": [{"type": "data", "data": result}]},
+                    task_id=task_id,
+                    agent_id="clinical_trial_orchestrator"
+                ))
                 
             except Exception as e:
                 log_error("workflow_error", str(e), {"pdf_path": pdf_path})
@@ -129,123 +212,173 @@ class A2AProtocolServer:
             if task_id not in self.tasks:
                 raise HTTPException(status_code=404, detail="Task not found")
             
+            cancel_workflow_task(task_id)
             self.tasks[task_id]["status"] = "cancelled"
             return {"status": "cancelled", "task_id": task_id}
     
     def register_agents(self):
         """Register all agents in the registry"""
-        
-        # Document Processing Agent
-        AGENT_REGISTRY["document_processing_agent"] = AgentInfo(
-            agent_id="document_processing_agent",
-            name="Document Processing Agent",
-            description="Processes patient PDF documents using Google Document AI",
-            capabilities=["pdf_parsing", "data_extraction", "medical_document_processing"],
-            endpoint="/agents/document_processing_agent/message"
-        ).dict()
-        
-        # Clinical Trials Agent
-        AGENT_REGISTRY["clinical_trials_agent"] = AgentInfo(
-            agent_id="clinical_trials_agent",
-            name="Clinical Trials Agent",
-            description="Fetches relevant clinical trials from clinicaltrials.gov",
-            capabilities=["trial_search", "condition_matching", "eligibility_filtering"],
-            endpoint="/agents/clinical_trials_agent/message"
-        ).dict()
-        
-        # Eligibility Analysis Agent
-        AGENT_REGISTRY["eligibility_analysis_agent"] = AgentInfo(
-            agent_id="eligibility_analysis_agent",
-            name="Eligibility Analysis Agent",
-            description="Analyzes patient eligibility for clinical trials using AI",
-            capabilities=["eligibility_analysis", "ai_reasoning", "criteria_matching"],
-            endpoint="/agents/eligibility_analysis_agent/message"
-        ).dict()
-        
-        # Orchestrator Agent
-        AGENT_REGISTRY["clinical_trial_orchestrator"] = AgentInfo(
-            agent_id="clinical_trial_orchestrator",
-            name="Clinical Trial Orchestrator",
-            description="Main orchestrator for clinical trial matching workflow",
-            capabilities=["workflow_orchestration", "agent_coordination", "result_aggregation"],
-            endpoint="/agents/clinical_trial_orchestrator/message"
-        ).dict()
+        AGENT_REGISTRY.update(_AGENTS)
     
-    async def process_agent_message(self, agent_id: str, message: Dict[str, Any]) -> Dict[str, Any]:
-        """Process message for a specific agent"""
+    async def process_agent_message(self, agent_id: str, message: Dict[str, Any], task_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Process message for a specific agent
         
+        Everything logged while handling the message (including by the agent) is
+        buffered in one trace, which is finalized off the event loop afterwards.
+        """
+        start_trace()
         log_workflow_step("a2a_message", {
             "agent_id": agent_id,
             "message_type": message.get("role", "unknown")
         })
         
+        response = None
         try:
-            # Convert message to A2A Protocol format
-            a2a_message = Message(
-                role=Role.user if message.get("role") == "user" else Role.agent,
-                parts=[TextPart(type="text", text=part.get("text", "")) for part in message.get("parts", [])]
-            )
-            
-            # Route to appropriate agent
-            if agent_id == "document_processing_agent":
-                # Extract PDF path from message
-                text = message.get("parts", [{}])[0].get("text", "")
-                if "pdf_path:" in text:
-                    pdf_path = text.split("pdf_path:")[1].strip()
-                    result = self.agents["document_agent"].parse_patient_pdf(pdf_path)
-                    return {"role": "agent", "parts": [{"type": "text", "text": json.dumps(result)}]}
-            
-            elif agent_id == "clinical_trials_agent":
-                # Extract patient data from message
-                text = message.get("parts", [{}])[0].get("text", "")
-                if "patient_data:" in text:
-                    patient_data_str = text.split("patient_data:")[1].strip()
-                    patient_data = json.loads(patient_data_str)
-                    result = self.agents["trials_agent"].fetch_clinical_trials(patient_data)
-                    return {"role": "agent", "parts": [{"type": "text", "text": json.dumps(result)}]}
-            
-            elif agent_id == "eligibility_analysis_agent":
-                # Extract patient data and trials from message
-                text = message.get("parts", [{}])[0].get("text", "")
-                if "patient_data:" in text and "trials:" in text:
-                    parts = text.split("trials:")
-                    patient_data_str = parts[0].split("patient_data:")[1].strip()
-                    trials_str = parts[1].strip()
-                    
-                    patient_data = json.loads(patient_data_str)
-                    trials = json.loads(trials_str)
-                    
-                    result = self.agents["eligibility_agent"].analyze_eligibility(patient_data, trials)
-                    return {"role": "agent", "parts": [{"type": "text", "text": json.dumps(result)}]}
-            
-            elif agent_id == "clinical_trial_orchestrator":
-                # Use the message handler
-                response = self.agents["message_handler"].handle_message(a2a_message)
-                return {
-                    "role": "agent",
-                    "parts": [{"type": "text", "text": response.parts[0].text if response.parts else ""}]
-                }
-            
+            if "data" in message:
+                payload = PatientPayload(**message["data"])
+                result = await self.dispatch_payload(agent_id, payload)
+                # Hand the result back as structured data; it is only serialized once, for the wire
+                response = {"role": "agent", "parts": [{"type": "data", "data": result}]}
+            elif A2A_LEGACY_TEXT_PARTS:
+                response = await self.process_legacy_text_message(agent_id, message)
             else:
-                raise ValueError(f"Unknown agent: {agent_id}")
-                
+                raise ValueError("Message has no data payload")
+            return response
+        
+        except asyncio.TimeoutError:
+            # Surfaced to the caller as a 504
+            log_error("a2a_message_timeout", "upstream timeout", message_log_context(agent_id, message, task_id))
+            raise
         except Exception as e:
-            log_error("agent_processing_error", str(e), {"agent_id": agent_id, "message": message})
-            return {
+            log_error("agent_processing_error", str(e), message_log_context(agent_id, message, task_id))
+            response = {
                 "role": "agent",
                 "parts": [{"type": "text", "text": f"Error processing message: {str(e)}"}]
             }
+            return response
+        finally:
+            schedule_finalize(response)
+    
+    async def dispatch_payload(self, agent_id: str, payload: PatientPayload) -> Any:
+        """Route a typed payload to the agent it is addressed to"""
+        
+        if agent_id == "document_processing_agent":
+            return await self.agents["document_agent"].parse_patient_pdf(require_field(payload, "pdf_path"))
+        
+        elif agent_id == "clinical_trials_agent":
+            return await self.agents["trials_agent"].fetch_clinical_trials(require_field(payload, "patient_data"))
+        
+        elif agent_id == "eligibility_analysis_agent":
+            return await self.agents["eligibility_agent"].analyze_eligibility(
+                require_field(payload, "patient_data"),
+                require_field(payload, "trials")
+            )
+        
+        elif agent_id == "clinical_trial_orchestrator":
+            return await self.agents["orchestrator"].run_full_workflow(require_field(payload, "pdf_path"))
+        
+        else:
+            raise ValueError(f"Unknown agent: {agent_id}")
+    
+    async def process_legacy_text_message(self, agent_id: str, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Process a message using the older "field:value" text part format"""
+        
+        # Convert message to A2A Protocol format
+        a2a_message = Message(
+            role=Role.user if message.get("role") == "user" else Role.agent,
+            parts=[TextPart(type="text", text=part.get("text", "")) for part in message.get("parts", [])]
+        )
+        
+        # Route to appropriate agent
+        if agent_id == "document_processing_agent":
+            # Extract PDF path from message
+            text = message.get("parts", [{}])[0].get("text", "")
+            if "pdf_path:" in text:
+                pdf_path = text.split("pdf_path:")[1].strip()
+                result = await self.agents["document_agent"].parse_patient_pdf(pdf_path)
+                return {"role": "agent", "parts": [{"type": "text", "text": orjson.dumps(result).decode()}]}
+        
+        elif agent_id == "clinical_trials_agent":
+            # Extract patient data from message
+            text = message.get("parts", [{}])[0].get("text", "")
+            if "patient_data:" in text:
+                patient_data_str = text.split("patient_data:")[1].strip()
+                patient_data = orjson.loads(patient_data_str)
+                result = await self.agents["trials_agent"].fetch_clinical_trials(patient_data)
+                return {"role": "agent", "parts": [{"type": "text", "text": orjson.dumps(result).decode()}]}
+        
+        elif agent_id == "eligibility_analysis_agent":
+            # Extract patient data and trials from message
+            text = message.get("parts", [{}])[0].get("text", "")
+            if "patient_data:" in text and "trials:" in text:
+                parts = text.split("trials:")
+                patient_data_str = parts[0].split("patient_data:")[1].strip()
+                trials_str = parts[1].strip()
+                
+                patient_data = orjson.loads(patient_data_str)
+                trials = orjson.loads(trials_str)
+                
+                result = await self.agents["eligibility_agent"].analyze_eligibility(patient_data, trials)
+                return {"role": "agent", "parts": [{"type": "text", "text": orjson.dumps(result).decode()}]}
+        
+        elif agent_id == "clinical_trial_orchestrator":
+            # Use the message handler
+            response = await self.agents["message_handler"].handle_message(a2a_message)
+            return {
+                "role": "agent",
+                "parts": [{"type": "text", "text": response.parts[0].text if response.parts else ""}]
+            }
+        
+        else:
+            raise ValueError(f"Unknown agent: {agent_id}")
+        
+        raise ValueError("Message is missing the fields this agent expects")
+
+
+def message_log_context(agent_id: str, message: Dict[str, Any], task_id: Optional[str] = None) -> Dict[str, Any]:
+    """Summarize a message for error logs without copying patient records or trial lists"""
+    data = message.get("data")
+    if not isinstance(data, dict):
+        data = {}
+    context = {"agent_id": agent_id, "task_id": task_id, "data_fields": sorted(data)}
+    if isinstance(data.get("patient_data"), dict):
+        context["patient_fp"] = patient_fingerprint(data["patient_data"])
+    if isinstance(data.get("trials"), list):
+        context["num_trials"] = len(data["trials"])
+    return context
+
+
+def require_field(payload: PatientPayload, field: str) -> Any:
+    """Get a required payload field, raising if the sender left it out"""
+    value = getattr(payload, field)
+    if value is None:
+        raise ValueError(f"Message data is missing '{field}'")
+    return value
 
 
 # Create the A2A server instance
-def create_a2a_server():
+def create_a2a_server(agents: Optional[Dict[str, Any]] = None):
     """Create and configure the A2A Protocol server"""
-    return A2AProtocolServer()
+    return A2AProtocolServer(agents)
+
+
+def create_a2a_app() -> FastAPI:
+    """App factory for running the A2A server standalone under uvicorn"""
+    logging.basicConfig(level=logging.WARNING)
+    return create_a2a_server().app
 
 
-# For testing the server
+# For testing the server (run from backend/: python -m agents.a2a_server)
 if __name__ == "__main__":
     import uvicorn
     
-    server = create_a2a_server()
-    uvicorn.run(server.app, host="0.0.0.0", port=8001) 
\ No newline at end of file
+    uvicorn.run(
+        "agents.a2a_server:create_a2a_app",
+        factory=True,
+        host="0.0.0.0",
+        port=8001,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", "4"))
+    ) 
\ No newline at end of file
@@ -3,7 +3,8 @@ Google ADK Agent Implementation for Clinical Trial Matching
 Refactors the existing workflow into proper Google ADK agents with A2A Protocol support
 """
 
-import json
+import asyncio
+import orjson
 import os
 from typing import Dict, List, Any, Optional
 from google.adk import Agent, Runner
@@ -11,17 +12,28 @@ from google.adk.tools import FunctionTool
 from a2a_protocol.dataclass import Message, TextPart, Role, Task, TaskStatus
 
 from services.document_ai import parse_pdf_with_document_ai
-from services.clinicaltrials_api import fetch_trials
-from services.vertex_ai import run_eligibility_analysis
+from services.cache import patient_fingerprint
+from services.clinicaltrials_api import fetch_trials_async
+from services.http_client import get_http_client
+from services.vertex_ai import ELIGIBILITY_BATCH_SIZE, analyze_trials_batch_async, get_mock_eligibility_analysis
 from tracing.weave_logger import (
     log_workflow_step, 
     log_patient_summary, 
     log_trials_summary, 
     log_eligibility_results,
     log_error,
-    finalize_session
+    start_trace
 )
 
+# Upper bound for the Document AI and clinicaltrials.gov calls made by the agents
+AGENT_CALL_TIMEOUT_SECONDS = 30
+
+# Upper bound for one batched eligibility prompt (including per-criterion retries)
+ELIGIBILITY_BATCH_TIMEOUT_SECONDS = 60
+
+# Gemini requests an eligibility agent may have in flight at once
+MAX_CONCURRENT_LLM_CALLS = 8
+
 class DocumentProcessingAgent:
     """ADK Agent for processing patient PDF documents using Google Document AI"""
     
@@ -38,7 +50,7 @@ class DocumentProcessingAgent:
             tools=[FunctionTool(self.parse_patient_pdf)]
         )
     
-    def parse_patient_pdf(self, pdf_path: str) -> dict:
+    async def parse_patient_pdf(self, pdf_path: str) -> dict:
         """
         Parse patient PDF document using Google Document AI
         
@@ -50,7 +62,10 @@ class DocumentProcessingAgent:
         """
         try:
             log_workflow_step("parsing_pdf", {"status": "starting", "file": pdf_path})
-            parsed_data = parse_pdf_with_document_ai(pdf_path)
+            parsed_data = await asyncio.wait_for(
+                asyncio.to_thread(parse_pdf_with_document_ai, pdf_path),
+                timeout=AGENT_CALL_TIMEOUT_SECONDS
+            )
             log_workflow_step("parsed_pdf", parsed_data)
             log_patient_summary(parsed_data)
             return parsed_data
@@ -75,7 +90,7 @@ class ClinicalTrialsAgent:
             tools=[FunctionTool(self.fetch_clinical_trials)]
         )
     
-    def fetch_clinical_trials(self, patient_data: dict) -> list:
+    async def fetch_clinical_trials(self, patient_data: dict) -> list:
         """
         Fetch relevant clinical trials based on patient data
         
@@ -90,12 +105,15 @@ class ClinicalTrialsAgent:
                 "status": "starting", 
                 "patient_conditions": patient_data.get("existing_conditions", [])
             })
-            trials = fetch_trials(patient_data)
+            trials = await asyncio.wait_for(
+                fetch_trials_async(patient_data, get_http_client()),
+                timeout=AGENT_CALL_TIMEOUT_SECONDS
+            )
             log_workflow_step("fetched_trials", {"num_trials": len(trials)})
             log_trials_summary(trials)
             return trials
         except Exception as e:
-            log_error("clinical_trials_error", str(e), {"patient_data": patient_data})
+            log_error("clinical_trials_error", str(e), {"patient_fp": patient_fingerprint(patient_data)})
             raise
 
 
@@ -114,11 +132,29 @@ class EligibilityAnalysisAgent:
             ),
             tools=[FunctionTool(self.analyze_eligibility)]
         )
+        # Created on first use so it binds to the running event loop
+        self._llm_semaphore = None
+    
+    def get_llm_semaphore(self) -> asyncio.Semaphore:
+        """Get the semaphore bounding concurrent Gemini requests"""
+        if self._llm_semaphore is None:
+            self._llm_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LLM_CALLS)
+        return self._llm_semaphore
     
-    def analyze_eligibility(self, patient_data: dict, trials: list) -> list:
+    async def analyze_batch(self, patient_data: dict, batch: list) -> list:
+        """Analyze one batch of trials within a timeout; each Gemini request holds the LLM semaphore"""
+        return await asyncio.wait_for(
+            analyze_trials_batch_async(patient_data, batch, get_http_client(), self.get_llm_semaphore()),
+            timeout=ELIGIBILITY_BATCH_TIMEOUT_SECONDS
+        )
+    
+    async def analyze_eligibility(self, patient_data: dict, trials: list) -> list:
         """
         Analyze patient eligibility for clinical trials
         
+        Trials are sent to Gemini in batches (one prompt per batch) and the batches
+        are analyzed concurrently, so the step takes as long as the slowest batch.
+        
         Args:
             patient_data: Dictionary containing patient information
             trials: List of clinical trials to analyze
@@ -131,13 +167,30 @@ class EligibilityAnalysisAgent:
                 "status": "starting", 
                 "num_trials": len(trials)
             })
-            eligibility_results = run_eligibility_analysis(patient_data, trials)
+            batches = [
+                trials[i:i + ELIGIBILITY_BATCH_SIZE]
+                for i in range(0, len(trials), ELIGIBILITY_BATCH_SIZE)
+            ]
+            batch_results = await asyncio.gather(
+                *(self.analyze_batch(patient_data, batch) for batch in batches),
+                return_exceptions=True
+            )
+            eligibility_results = []
+            for batch, results in zip(batches, batch_results):
+                # BaseException, since a cancelled batch comes back as CancelledError
+                if isinstance(results, BaseException):
+                    # Fall back to mock analysis for this batch only
+                    log_error("eligibility_analysis_error", str(results) or type(results).__name__, {
+                        "trial_ids": [trial.get("trial_id") for trial in batch]
+                    })
+                    results = get_mock_eligibility_analysis(patient_data, batch)
+                eligibility_results.extend(results)
             log_workflow_step("eligibility_analysis", eligibility_results)
             log_eligibility_results(eligibility_results)
             return eligibility_results
         except Exception as e:
             log_error("eligibility_analysis_error", str(e), {
-                "patient_data": patient_data,
+                "patient_fp": patient_fingerprint(patient_data),
                 "num_trials": len(trials)
             })
             raise
@@ -163,10 +216,14 @@ class ClinicalTrialOrchestrator:
             tools=[FunctionTool(self.run_full_workflow)]
         )
     
-    def run_full_workflow(self, patient_pdf_path: str) -> dict:
+    async def run_full_workflow(self, patient_pdf_path: str) -> dict:
         """
         Run the complete clinical trial matching workflow
         
+        The workflow's telemetry stays buffered; the caller finalizes the session
+        (see tasks.schedule_finalize) once it has responded. Steps the caller
+        buffered before starting the workflow are carried into its session.
+        
         Args:
             patient_pdf_path: Path to the patient PDF file
             
@@ -174,19 +231,22 @@ class ClinicalTrialOrchestrator:
             Complete workflow results
         """
         context = {"pdf_path": patient_pdf_path}
+        patient_fp = None
+        start_trace()
         log_workflow_step("start_workflow", context)
         
         try:
             # Step 1: Document Processing
-            parsed_data = self.document_agent.parse_patient_pdf(patient_pdf_path)
+            parsed_data = await self.document_agent.parse_patient_pdf(patient_pdf_path)
             context["parsed_data"] = parsed_data
+            patient_fp = patient_fingerprint(parsed_data)
             
             # Step 2: Clinical Trials Search
-            trials = self.trials_agent.fetch_clinical_trials(parsed_data)
+            trials = await self.trials_agent.fetch_clinical_trials(parsed_data)
             context["trials"] = trials
             
             # Step 3: Eligibility Analysis
-            eligibility_results = self.eligibility_agent.analyze_eligibility(parsed_data, trials)
+            eligibility_results = await self.eligibility_agent.analyze_eligibility(parsed_data, trials)
             context["eligibility_results"] = eligibility_results
             
             # Step 4: Finalize
@@ -196,14 +256,15 @@ class ClinicalTrialOrchestrator:
                 "total_trials": len(trials), 
                 "eligible_trials": eligible_count
             })
-            finalize_session(context)
             
             return context
             
         except Exception as e:
+            # The full context is large; log where the workflow got to instead
             error_context = {
                 "pdf_path": patient_pdf_path,
-                "current_context": context
+                "completed_steps": [key for key in context if key != "pdf_path"],
+                "patient_fp": patient_fp
             }
             log_error("workflow_error", str(e), error_context)
             
@@ -218,7 +279,7 @@ class A2AMessageHandler:
     def __init__(self, orchestrator: ClinicalTrialOrchestrator):
         self.orchestrator = orchestrator
     
-    def handle_message(self, message: Message) -> Message:
+    async def handle_message(self, message: Message) -> Message:
         """
         Handle incoming A2A Protocol messages
         
@@ -237,10 +298,11 @@ class A2AMessageHandler:
                         pdf_path = text_part.text.split("pdf_path:")[1].strip()
                         
                         # Run the workflow
-                        results = self.orchestrator.run_full_workflow(pdf_path)
+                        # The A2A server finalizes the message's trace once it has responded
+                        results = await self.orchestrator.run_full_workflow(pdf_path)
                         
                         # Create response message
-                        response_text = json.dumps(results, indent=2)
+                        response_text = orjson.dumps(results, option=orjson.OPT_INDENT_2).decode()
                         return Message(
                             role=Role.agent,
                             parts=[TextPart(type="text", text=response_text)]
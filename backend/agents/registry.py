@@ -0,0 +1,16 @@
+"""
+Process-wide registry of the Google ADK agents
+Agents are built once and shared by the main app, the A2A server and tests
+"""
+
+from functools import lru_cache
+from typing import Dict, Any
+
+from agents.adk_agents import initialize_adk_agents
+
+@lru_cache(maxsize=1)
+def get_agents() -> Dict[str, Any]:
+    """
+    Get the shared ADK agents, initializing them on first use
+    """
+    return initialize_adk_agents()
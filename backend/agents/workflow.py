@@ -1,6 +1,7 @@
 # Placeholder for Google ADK agent workflow
 # This will define the agent orchestration using A2A protocol and MCP
 
+from services.cache import patient_fingerprint
 from services.document_ai import parse_pdf_with_document_ai
 from services.clinicaltrials_api import fetch_trials
 from services.vertex_ai import run_eligibility_analysis
@@ -10,7 +11,8 @@ from tracing.weave_logger import (
     log_trials_summary, 
     log_eligibility_results,
     log_error,
-    finalize_session
+    finalize_session,
+    start_trace
 )
 
 def run_agent_workflow(patient_pdf_path):
@@ -18,6 +20,7 @@ def run_agent_workflow(patient_pdf_path):
     Run the complete agent workflow with enhanced logging
     """
     context = {"pdf_path": patient_pdf_path}
+    start_trace()
     log_workflow_step("start_workflow", context)
     
     try:
@@ -49,9 +52,11 @@ def run_agent_workflow(patient_pdf_path):
         return context
         
     except Exception as e:
+        # The full context is large; log where the workflow got to instead
         error_context = {
             "pdf_path": patient_pdf_path,
-            "current_context": context
+            "completed_steps": [key for key in context if key != "pdf_path"],
+            "patient_fp": patient_fingerprint(context["parsed_data"]) if "parsed_data" in context else None
         }
         log_error("workflow_error", str(e), error_context)
         
@@ -1,14 +1,50 @@
-from fastapi import FastAPI, UploadFile, File
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, FastAPI, HTTPException, UploadFile, File, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import hashlib
+import logging
 import os
+import tempfile
+from typing import Tuple
 from agents.workflow import run_agent_workflow
+from agents.registry import get_agents
 from agents.a2a_server import create_a2a_server
-from tracing.weave_logger import log_workflow_step
+from services.cache import WORKFLOW_CACHE, record_cache_lookup
+from services.document_ai import close_documentai_client
+from services.http_client import get_http_client, close_http_client
+from tasks import add_completed_task, submit_workflow_task
+from tracing.weave_logger import capture_trace, finalize_session, log_workflow_step, start_trace
+
+# Service fallbacks log warnings (with tracebacks) instead of printing
+logging.basicConfig(level=logging.WARNING)
 
 UPLOAD_DIR = "uploads"
+UPLOAD_CHUNK_SIZE = 64 * 1024
+ALLOWED_UPLOAD_EXTENSIONS = {".pdf", ".txt"}
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-app = FastAPI(title="Clinical Trial Matching API with Google ADK + A2A Protocol")
+# A2A Protocol server; its agents are attached at startup
+a2a_server = create_a2a_server()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the ADK agents and shared HTTP client once per process"""
+    app.state.http = get_http_client()
+    agents = get_agents()
+    app.state.orchestrator = agents["orchestrator"]
+    a2a_server.agents = agents
+    yield
+    await close_http_client()
+    close_documentai_client()
+
+app = FastAPI(
+    title="Clinical Trial Matching API with Google ADK + A2A Protocol",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,70 +54,108 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize A2A Protocol server
-a2a_server = create_a2a_server()
-
-# Mount A2A Protocol endpoints
+# Mount A2A Protocol endpoints (agent discovery, messages and tasks live under /a2a)
 app.mount("/a2a", a2a_server.app)
 
+def upload_extension(filename: str) -> str:
+    """Get the extension of an uploaded file, rejecting unsupported file types"""
+    extension = os.path.splitext(os.path.basename(filename or ""))[1].lower()
+    if extension not in ALLOWED_UPLOAD_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {extension or 'none'}")
+    return extension
+
+def save_upload(file: UploadFile) -> Tuple[str, str]:
+    """
+    Stream an uploaded file to the uploads directory in fixed-size chunks
+    
+    The file is named by the SHA-256 of its contents (never by the client's
+    filename); returns the saved path and the digest.
+    """
+    extension = upload_extension(file.filename)
+    digest = hashlib.sha256()
+    fd, temp_location = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = file.file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+        file_location = os.path.join(UPLOAD_DIR, f"{digest.hexdigest()}{extension}")
+        os.replace(temp_location, file_location)
+    except BaseException:
+        if os.path.exists(temp_location):
+            os.remove(temp_location)
+        raise
+    return file_location, digest.hexdigest()
+
+def get_cached_workflow_result(digest: str):
+    """Get the workflow result for a previously processed file, if still cached"""
+    cache_key = f"workflow:{digest}"
+    result = WORKFLOW_CACHE.get(cache_key)
+    if result is not None:
+        record_cache_lookup("workflow", [cache_key], [])
+    else:
+        record_cache_lookup("workflow", [], [cache_key])
+    return result
+
 @app.get("/health")
 def health():
     return {"status": "ok", "version": "Phase 2 - Google ADK + A2A Protocol"}
 
 @app.post("/upload-pdf")
-def upload_pdf(file: UploadFile = File(...)):
+def upload_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """Legacy endpoint - uses original workflow"""
-    file_location = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_location, "wb") as f:
-        f.write(file.file.read())
+    file_location, digest = save_upload(file)
+    # Buffer the upload and cache lookup; the workflow's own session picks them up
+    start_trace()
     log_workflow_step("upload_pdf", {"filename": file.filename})
-    result = run_agent_workflow(file_location)
+    result = get_cached_workflow_result(digest)
+    if result is None:
+        result = run_agent_workflow(file_location)
+        if result.get("status") != "failed":
+            WORKFLOW_CACHE.set(f"workflow:{digest}", result)
+    else:
+        # Cache hit: no workflow runs, so emit the buffered steps after responding
+        background_tasks.add_task(finalize_session, result, capture_trace())
     return {"filename": file.filename, "workflow_result": result}
 
-@app.post("/upload-pdf-adk")
-async def upload_pdf_adk(file: UploadFile = File(...)):
-    """New endpoint - uses Google ADK agents with A2A Protocol"""
-    file_location = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_location, "wb") as f:
-        f.write(file.file.read())
+@app.post("/upload-pdf-adk", status_code=202)
+async def upload_pdf_adk(request: Request, file: UploadFile = File(...)):
+    """
+    New endpoint - uses Google ADK agents with A2A Protocol
+    
+    The workflow runs in the background; poll /a2a/tasks/{task_id} for the result.
+    """
+    # Copy in a worker thread so large uploads don't block the event loop
+    file_location, digest = await run_in_threadpool(save_upload, file)
     
+    # Buffer the upload and cache lookup instead of starting a W&B run on the event loop;
+    # the background workflow task inherits this trace and emits them with its session
+    start_trace()
     log_workflow_step("upload_pdf_adk", {"filename": file.filename})
     
-    # Use A2A Protocol to run workflow
-    try:
-        # Use the orchestrator agent directly
-        from agents.adk_agents import ClinicalTrialOrchestrator
-        orchestrator = ClinicalTrialOrchestrator()
-        response = orchestrator.run_full_workflow(file_location)
-        
-        return {
-            "filename": file.filename, 
-            "workflow_result": response,
-            "agent_system": "Google ADK + A2A Protocol"
-        }
-    except Exception as e:
-        # Fall back to original workflow if A2A fails
-        print(f"A2A workflow failed: {e}, falling back to original workflow")
-        result = run_agent_workflow(file_location)
-        return {
-            "filename": file.filename, 
-            "workflow_result": result,
-            "agent_system": "Fallback - Original Workflow"
-        }
-
-@app.get("/agents")
-async def list_agents():
-    """List all available agents"""
-    return await a2a_server.app.get("/agents")
-
-@app.get("/agents/{agent_id}")
-async def get_agent_info(agent_id: str):
-    """Get information about a specific agent"""
-    return await a2a_server.app.get(f"/agents/{agent_id}")
-
-@app.post("/agents/{agent_id}/message")
-async def send_agent_message(agent_id: str, message: dict):
-    """Send a message to a specific agent"""
-    from agents.a2a_server import A2ARequest
-    request = A2ARequest(agent_id=agent_id, message=message)
-    return await a2a_server.app.post(f"/agents/{agent_id}/message", json=request.dict()) 
\ No newline at end of file
+    # Identical files skip the workflow entirely
+    cached_result = get_cached_workflow_result(digest)
+    if cached_result is not None:
+        task_id = add_completed_task(file.filename, cached_result)
+        # No workflow runs, so the buffered steps are emitted in a worker thread after responding
+        return ORJSONResponse(
+            {"task_id": task_id, "status": "completed", "filename": file.filename},
+            status_code=200,
+            background=BackgroundTask(finalize_session, cached_result, capture_trace())
+        )
+    
+    # Run the workflow with the shared orchestrator agent (falls back to the original workflow)
+    task_id = submit_workflow_task(
+        request.app.state.orchestrator,
+        file_location,
+        file.filename,
+        cache_key=f"workflow:{digest}"
+    )
+    
+    return ORJSONResponse(
+        {"task_id": task_id, "status": "pending", "filename": file.filename},
+        status_code=202
+    )
\ No newline at end of file
@@ -0,0 +1,81 @@
+import copy
+import hashlib
+import orjson
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from tracing.weave_logger import log_workflow_step
+
+class TTLCache:
+    """
+    Thread-safe in-memory cache with per-entry expiry and LRU eviction
+    """
+
+    def __init__(self, ttl_seconds: float, maxsize: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Return a copy of the cached value, or None if missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return copy.deepcopy(value)
+
+    def set(self, key: str, value: Any):
+        """
+        Store a copy of the value, evicting the least recently used entry if full
+        """
+        entry = (time.monotonic() + self.ttl_seconds, copy.deepcopy(value))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+def stable_hash(value: Any) -> str:
+    """
+    Hash a JSON-compatible value independent of dict key order
+    """
+    encoded = orjson.dumps(value, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS)
+    return hashlib.sha1(encoded).hexdigest()
+
+def patient_fingerprint(patient_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compact identifier for a patient record, logged in place of the full record
+    """
+    return {
+        "conditions": patient_data.get("existing_conditions", []),
+        "age": patient_data.get("age"),
+        "hash": stable_hash(patient_data)
+    }
+
+def record_cache_lookup(cache_name: str, hits: List[str], misses: List[str]):
+    """
+    Log which keys were served from a cache and which had to be computed
+    """
+    if hits:
+        log_workflow_step("cache_hit", {"cache": cache_name, "keys": hits, "count": len(hits)})
+    if misses:
+        log_workflow_step("cache_miss", {"cache": cache_name, "keys": misses, "count": len(misses)})
+
+# Trial search results change slowly; eligibility verdicts are stable per patient and trial
+TRIALS_CACHE = TTLCache(ttl_seconds=3600)
+ELIGIBILITY_CACHE = TTLCache(ttl_seconds=24 * 3600, maxsize=4096)
+
+# Generic criteria ("Age >= 18") recur across trials, so single verdicts are cached too
+CRITERION_CACHE = TTLCache(ttl_seconds=24 * 3600, maxsize=4096)
+
+# Workflow results keyed by the SHA-256 of the uploaded file
+WORKFLOW_CACHE = TTLCache(ttl_seconds=3600, maxsize=256)
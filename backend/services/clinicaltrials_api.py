@@ -1,6 +1,31 @@
-import requests
-import json
+import httpx
+import logging
+import orjson
 from typing import List, Dict, Any
+from services.cache import TRIALS_CACHE, record_cache_lookup, stable_hash
+from services.http_client import build_session
+
+logger = logging.getLogger(__name__)
+
+CLINICALTRIALS_API_URL = "https://clinicaltrials.gov/api/v2/studies"
+
+# Study fields requested from the API (everything parse_trials_data uses)
+STUDY_FIELDS = (
+    "NCTId",
+    "BriefTitle",
+    "DetailedDescription",
+    "Condition",
+    "EligibilityCriteria",
+    "MinimumAge",
+    "MaximumAge",
+    "Gender"
+)
+
+# Pooled session for the synchronous workflow, so connections are reused
+_SESSION = build_session()
+
+# Bullet, numbering and whitespace characters stripped from the start of a criteria line
+_BULLET_CHARS = "\u2022\u00b7-*0123456789. \t"
 
 def fetch_trials(patient_data: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
@@ -10,16 +35,49 @@ def fetch_trials(patient_data: Dict[str, Any]) -> List[Dict[str, Any]]:
         # Build search query based on patient conditions
         search_terms = build_search_query(patient_data)
         
+        # Reuse a recent search for the same conditions
+        cache_key = trials_cache_key(search_terms)
+        cached_trials = TRIALS_CACHE.get(cache_key)
+        if cached_trials is not None:
+            record_cache_lookup("trials", [cache_key], [])
+            return cached_trials
+        record_cache_lookup("trials", [], [cache_key])
+        
         # Call clinicaltrials.gov API v2
         trials_data = call_clinicaltrials_api(search_terms)
         
         # Parse and structure the trial data
         structured_trials = parse_trials_data(trials_data)
+        TRIALS_CACHE.set(cache_key, structured_trials)
         
         return structured_trials
         
-    except Exception as e:
-        print(f"Error fetching trials from clinicaltrials.gov: {str(e)}")
+    except Exception:
+        logger.warning("Error fetching trials from clinicaltrials.gov", exc_info=True)
+        # Return mock data as fallback
+        return get_mock_trials()
+
+async def fetch_trials_async(patient_data: Dict[str, Any], client: httpx.AsyncClient) -> List[Dict[str, Any]]:
+    """
+    Fetch clinical trials using a shared async HTTP client
+    """
+    try:
+        search_terms = build_search_query(patient_data)
+        
+        cache_key = trials_cache_key(search_terms)
+        cached_trials = TRIALS_CACHE.get(cache_key)
+        if cached_trials is not None:
+            record_cache_lookup("trials", [cache_key], [])
+            return cached_trials
+        record_cache_lookup("trials", [], [cache_key])
+        
+        trials_data = await call_clinicaltrials_api_async(search_terms, client)
+        structured_trials = parse_trials_data(trials_data)
+        TRIALS_CACHE.set(cache_key, structured_trials)
+        return structured_trials
+        
+    except Exception:
+        logger.warning("Error fetching trials from clinicaltrials.gov", exc_info=True)
         # Return mock data as fallback
         return get_mock_trials()
 
@@ -29,10 +87,14 @@ def build_search_query(patient_data: Dict[str, Any]) -> str:
     """
     search_terms = []
     
-    # Add existing conditions to search
+    # Add existing conditions to search, skipping repeats (case-insensitive)
+    seen_terms = set()
     if patient_data.get("existing_conditions"):
         for condition in patient_data["existing_conditions"]:
-            search_terms.append(condition.strip())
+            term = condition.strip()
+            if term and term.lower() not in seen_terms:
+                seen_terms.add(term.lower())
+                search_terms.append(term)
     
     # Add age-related terms if age is available
     if patient_data.get("age"):
@@ -46,31 +108,53 @@ def build_search_query(patient_data: Dict[str, Any]) -> str:
     query = " OR ".join(search_terms) if search_terms else "diabetes"
     return query
 
+def trials_cache_key(search_query: str) -> str:
+    """
+    Build the trials cache key for a search query, independent of term order
+    """
+    return "trials:" + stable_hash(sorted(search_query.split(" OR ")))
+
 def call_clinicaltrials_api(search_query: str, max_studies: int = 10) -> Dict[str, Any]:
     """
     Call the clinicaltrials.gov API v2 to fetch studies
     """
-    base_url = "https://clinicaltrials.gov/api/v2/studies"
+    params = build_api_params(search_query, max_studies)
     
-    params = {
+    response = _SESSION.get(CLINICALTRIALS_API_URL, params=params, timeout=30)
+    response.raise_for_status()
+    
+    return orjson.loads(response.content)
+
+async def call_clinicaltrials_api_async(search_query: str, client: httpx.AsyncClient, max_studies: int = 10) -> Dict[str, Any]:
+    """
+    Call the clinicaltrials.gov API v2 using the given async client
+    """
+    params = build_api_params(search_query, max_studies)
+    
+    response = await client.get(CLINICALTRIALS_API_URL, params=params)
+    response.raise_for_status()
+    
+    return orjson.loads(response.content)
+
+def build_api_params(search_query: str, max_studies: int) -> Dict[str, Any]:
+    """
+    Build query parameters for the clinicaltrials.gov studies endpoint
+    """
+    return {
         "query.cond": search_query,
         "filter.overallStatus": "RECRUITING",
         "format": "json",
-        "countTotal": "true",
         "pageSize": max_studies,
-        "fields": "NCTId,BriefTitle,DetailedDescription,Condition,EligibilityCriteria,MinimumAge,MaximumAge,Gender,HealthyVolunteers,StdAge"
+        # Only the fields parse_trials_data reads, so the response stays small
+        "fields": ",".join(STUDY_FIELDS)
     }
-    
-    response = requests.get(base_url, params=params, timeout=30)
-    response.raise_for_status()
-    
-    return response.json()
 
 def parse_trials_data(trials_data: Dict[str, Any]) -> List[Dict[str, Any]]:
     """
     Parse and structure the trials data from clinicaltrials.gov API response
     """
     structured_trials = []
+    seen_trial_ids = set()
     
     studies = trials_data.get("studies", [])
     
@@ -84,6 +168,12 @@ def parse_trials_data(trials_data: Dict[str, Any]) -> List[Dict[str, Any]]:
         trial_id = identification_module.get("nctId", "Unknown")
         title = identification_module.get("briefTitle", "Unknown Title")
         
+        # Skip studies already seen so each trial is only analyzed once
+        if trial_id != "Unknown":
+            if trial_id in seen_trial_ids:
+                continue
+            seen_trial_ids.add(trial_id)
+        
         # Extract eligibility criteria
         eligibility_text = eligibility_module.get("eligibilityCriteria", "")
         criteria = parse_eligibility_criteria(eligibility_text)
@@ -128,54 +218,40 @@ def parse_trials_data(trials_data: Dict[str, Any]) -> List[Dict[str, Any]]:
 def parse_eligibility_criteria(eligibility_text: str) -> List[Dict[str, str]]:
     """
     Parse eligibility criteria text into structured inclusion/exclusion criteria
+    
+    Criteria are inclusion until the "Exclusion Criteria:" header; the text is
+    walked line by line in a single pass.
     """
     criteria = []
     
     if not eligibility_text:
         return criteria
     
-    # Split by common section headers
-    sections = eligibility_text.split("Exclusion Criteria:")
-    
-    # Process inclusion criteria
-    if sections[0]:
-        inclusion_text = sections[0].replace("Inclusion Criteria:", "").strip()
-        inclusion_criteria = extract_criteria_items(inclusion_text, "inclusion")
-        criteria.extend(inclusion_criteria)
-    
-    # Process exclusion criteria
-    if len(sections) > 1:
-        exclusion_text = sections[1].strip()
-        exclusion_criteria = extract_criteria_items(exclusion_text, "exclusion")
-        criteria.extend(exclusion_criteria)
+    criteria_type = "inclusion"
+    for line in eligibility_text.splitlines():
+        if criteria_type == "inclusion" and "Exclusion Criteria:" in line:
+            # Text before the header on the same line is still inclusion
+            before, line = line.split("Exclusion Criteria:", 1)
+            append_criterion(criteria, before.replace("Inclusion Criteria:", ""), criteria_type)
+            criteria_type = "exclusion"
+        elif criteria_type == "inclusion":
+            line = line.replace("Inclusion Criteria:", "")
+        append_criterion(criteria, line, criteria_type)
     
     return criteria
 
-def extract_criteria_items(text: str, criteria_type: str) -> List[Dict[str, str]]:
+def append_criterion(criteria: List[Dict[str, str]], line: str, criteria_type: str):
     """
-    Extract individual criteria items from text
+    Append one criteria line, without its bullet or numbering, unless it is too short
     """
-    items = []
-    
-    # Split by common bullet points or numbering
-    lines = text.split('\n')
-    
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-            
-        # Remove common bullet points and numbering
-        line = line.lstrip('•-*').strip()
-        line = line.lstrip('123456789.').strip()
-        
-        if len(line) > 10:  # Filter out very short lines
-            items.append({
-                "criterion": line,
-                "type": criteria_type
-            })
+    # Remove common bullet points and numbering
+    line = line.strip().lstrip(_BULLET_CHARS)
     
-    return items
+    if len(line) > 10:  # Filter out very short lines
+        criteria.append({
+            "criterion": line,
+            "type": criteria_type
+        })
 
 def get_mock_trials() -> List[Dict[str, Any]]:
     """
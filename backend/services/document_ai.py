@@ -3,34 +3,71 @@ from google.cloud import documentai_v1 as documentai
 from google.oauth2 import service_account
 from config import DOCUMENT_AI_PROCESSOR_ID, DOCUMENT_AI_PROJECT_ID, DOCUMENT_AI_LOCATION, GOOGLE_APPLICATION_CREDENTIALS
 import json
+import logging
 import re
+import threading
 
-def parse_pdf_with_document_ai(pdf_path):
+logger = logging.getLogger(__name__)
+
+# Credentials and processor are fixed per deployment, so they are resolved once at import
+os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GOOGLE_APPLICATION_CREDENTIALS
+PROCESSOR_NAME = f"projects/{DOCUMENT_AI_PROJECT_ID}/locations/{DOCUMENT_AI_LOCATION}/processors/{DOCUMENT_AI_PROCESSOR_ID}"
+
+# Shared Document AI client; its gRPC channel stays open across requests
+_client = None
+_client_lock = threading.Lock()
+
+def get_documentai_client():
     """
-    Parse PDF using Google Document AI and extract patient data
+    Get the process-wide Document AI client, creating it on first use
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = documentai.DocumentProcessorServiceClient()
+    return _client
+
+def close_documentai_client():
+    """
+    Close the shared Document AI client's channel (called on application shutdown)
     """
-    # Set up credentials
-    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = GOOGLE_APPLICATION_CREDENTIALS
+    global _client
+    if _client is not None:
+        _client.transport.close()
+        _client = None
+
+def parse_pdf_with_document_ai(pdf_path, return_raw=False):
+    """
+    Parse PDF using Google Document AI and extract patient data
     
+    pdf_path is a local file or a gs:// URI. The full extracted text is only
+    included (as "raw_text") when return_raw is set.
+    """
     try:
-        # Initialize Document AI client
-        client = documentai.DocumentProcessorServiceClient()
+        # Reuse the shared Document AI client
+        client = get_documentai_client()
         
-        # Construct the processor name
-        processor_name = f"projects/{DOCUMENT_AI_PROJECT_ID}/locations/{DOCUMENT_AI_LOCATION}/processors/{DOCUMENT_AI_PROCESSOR_ID}"
-        
-        # Read the PDF file
-        with open(pdf_path, "rb") as pdf_file:
-            pdf_content = pdf_file.read()
-        
-        # Create the request
-        request = documentai.ProcessRequest(
-            name=processor_name,
-            raw_document=documentai.RawDocument(
-                content=pdf_content,
-                mime_type="application/pdf"
+        # Create the request; documents already in Cloud Storage are read by Document AI
+        # directly instead of being loaded into memory here
+        if pdf_path.startswith("gs://"):
+            request = documentai.ProcessRequest(
+                name=PROCESSOR_NAME,
+                gcs_document=documentai.GcsDocument(
+                    gcs_uri=pdf_path,
+                    mime_type="application/pdf"
+                )
+            )
+        else:
+            with open(pdf_path, "rb") as pdf_file:
+                pdf_content = pdf_file.read()
+            request = documentai.ProcessRequest(
+                name=PROCESSOR_NAME,
+                raw_document=documentai.RawDocument(
+                    content=pdf_content,
+                    mime_type="application/pdf"
+                )
             )
-        )
         
         # Process the document
         result = client.process_document(request=request)
@@ -40,26 +77,83 @@ def parse_pdf_with_document_ai(pdf_path):
         text = document.text
         
         # Parse patient data from the extracted text
-        patient_data = extract_patient_data_from_text(text)
+        patient_data = extract_patient_data_from_text(text, return_raw=return_raw)
         
         return patient_data
         
-    except Exception as e:
-        print(f"Error processing PDF with Document AI: {str(e)}")
+    except Exception:
+        logger.warning("Error processing PDF with Document AI", exc_info=True)
         # Return mock data as fallback
-        return {
+        patient_data = {
             "name": "John Doe",
             "age": 55,
             "allergies": ["Penicillin"],
             "existing_conditions": ["Diabetes"],
             "lab_results": {"WBC": 5.2, "Hemoglobin": 13.5},
-            "summary": "Patient with diabetes, age 55, no major allergies except penicillin.",
-            "raw_text": "Error processing PDF - using mock data"
+            "summary": "Patient with diabetes, age 55, no major allergies except penicillin."
         }
+        if return_raw:
+            patient_data["raw_text"] = "Error processing PDF - using mock data"
+        return patient_data
+
+# Field labels as (field, pattern), written in lowercase. Within a field the first
+# listed pattern that matches anywhere wins. Lab values are independent, and Hgb
+# overrides Hemoglobin.
+_FIELD_LABELS = [
+    ("name", r"patient name:\s*([a-z\s]+)"),
+    ("name", r"name:\s*([a-z\s]+)"),
+    ("name", r"patient:\s*([a-z\s]+)"),
+    ("age", r"age:\s*(\d+)"),
+    ("age", r"(\d+)\s*years?\s*old"),
+    ("age", r"(\d+)\s*yo"),
+    ("allergies", r"allergies?:\s*([^.\n]+)"),
+    ("allergies", r"allergic to:\s*([^.\n]+)"),
+    ("allergies", r"drug allergies?:\s*([^.\n]+)"),
+    ("conditions", r"diagnosis:\s*([^.\n]+)"),
+    ("conditions", r"medical history:\s*([^.\n]+)"),
+    ("conditions", r"conditions?:\s*([^.\n]+)"),
+    ("conditions", r"pmh:\s*([^.\n]+)"),
+    ("WBC", r"wbc:\s*(\d+\.?\d*)"),
+    ("Hemoglobin", r"hgb:\s*(\d+\.?\d*)"),
+    ("Hemoglobin", r"hemoglobin:\s*(\d+\.?\d*)"),
+    ("Glucose", r"glucose:\s*(\d+\.?\d*)"),
+    ("Creatinine", r"creatinine:\s*(\d+\.?\d*)")
+]
+# Each label compiled once as (field, case-sensitive pattern for lowercased text, case-insensitive pattern)
+_FIELD_PATTERNS = [
+    (field, re.compile(pattern), re.compile(pattern, re.IGNORECASE)) for field, pattern in _FIELD_LABELS
+]
+_LAB_FIELDS = ("WBC", "Hemoglobin", "Glucose", "Creatinine")
+
+def find_labeled_values(text):
+    """
+    Find the value of each labeled field, keeping the original text's casing
+    
+    The text is lowercased once and searched with case-sensitive patterns, which
+    lets the regex engine jump straight to each literal label (IGNORECASE
+    searches are ~20x slower). If lowercasing changed the length (some non-ASCII
+    characters), positions wouldn't line up, so the text is searched
+    case-insensitively instead.
+    """
+    lowered = text.lower()
+    aligned = len(lowered) == len(text)
+    haystack = lowered if aligned else text
+    
+    values = {}
+    for field, pattern, ci_pattern in _FIELD_PATTERNS:
+        if field in values:
+            continue
+        match = (pattern if aligned else ci_pattern).search(haystack)
+        if match:
+            values[field] = text[match.start(1):match.end(1)]
+    return values
 
-def extract_patient_data_from_text(text):
+def extract_patient_data_from_text(text, return_raw=False):
     """
     Extract structured patient data from raw text using regex patterns
+    
+    The summary keeps the first 500 characters; the full text is only kept
+    (as "raw_text") when return_raw is set.
     """
     patient_data = {
         "name": "Unknown",
@@ -67,73 +161,34 @@ def extract_patient_data_from_text(text):
         "allergies": [],
         "existing_conditions": [],
         "lab_results": {},
-        "summary": text[:500] + "..." if len(text) > 500 else text,
-        "raw_text": text
+        "summary": text[:500] + "..." if len(text) > 500 else text
     }
+    if return_raw:
+        patient_data["raw_text"] = text
+    values = find_labeled_values(text)
     
-    # Extract name (look for "Patient Name:", "Name:", etc.)
-    name_patterns = [
-        r"Patient Name:\s*([A-Za-z\s]+)",
-        r"Name:\s*([A-Za-z\s]+)",
-        r"Patient:\s*([A-Za-z\s]+)"
-    ]
-    for pattern in name_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            patient_data["name"] = match.group(1).strip()
-            break
+    # Name (look for "Patient Name:", "Name:", etc.)
+    if "name" in values:
+        patient_data["name"] = values["name"].strip()
     
-    # Extract age
-    age_patterns = [
-        r"Age:\s*(\d+)",
-        r"(\d+)\s*years?\s*old",
-        r"(\d+)\s*yo"
-    ]
-    for pattern in age_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            patient_data["age"] = int(match.group(1))
-            break
+    # Age
+    if "age" in values:
+        patient_data["age"] = int(values["age"])
     
-    # Extract allergies
-    allergy_patterns = [
-        r"Allergies?:\s*([^.\n]+)",
-        r"Allergic to:\s*([^.\n]+)",
-        r"Drug allergies?:\s*([^.\n]+)"
-    ]
-    for pattern in allergy_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            allergies_text = match.group(1).strip()
-            if "none" not in allergies_text.lower() and "nkda" not in allergies_text.lower():
-                patient_data["allergies"] = [a.strip() for a in allergies_text.split(",")]
-            break
+    # Allergies
+    if "allergies" in values:
+        allergies_text = values["allergies"].strip()
+        if "none" not in allergies_text.lower() and "nkda" not in allergies_text.lower():
+            patient_data["allergies"] = [a.strip() for a in allergies_text.split(",")]
     
-    # Extract conditions/diagnoses
-    condition_patterns = [
-        r"Diagnosis:\s*([^.\n]+)",
-        r"Medical History:\s*([^.\n]+)",
-        r"Conditions?:\s*([^.\n]+)",
-        r"PMH:\s*([^.\n]+)"
-    ]
-    for pattern in condition_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            conditions_text = match.group(1).strip()
-            patient_data["existing_conditions"] = [c.strip() for c in conditions_text.split(",")]
-            break
+    # Conditions/diagnoses
+    if "conditions" in values:
+        conditions_text = values["conditions"].strip()
+        patient_data["existing_conditions"] = [c.strip() for c in conditions_text.split(",")]
     
-    # Extract lab results (basic patterns)
-    lab_patterns = [
-        (r"WBC:\s*(\d+\.?\d*)", "WBC"),
-        (r"Hemoglobin:\s*(\d+\.?\d*)", "Hemoglobin"),
-        (r"Hgb:\s*(\d+\.?\d*)", "Hemoglobin"),
-        (r"Glucose:\s*(\d+\.?\d*)", "Glucose"),
-        (r"Creatinine:\s*(\d+\.?\d*)", "Creatinine")
-    ]
-    for pattern, lab_name in lab_patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            patient_data["lab_results"][lab_name] = float(match.group(1))
+    # Lab results (basic patterns)
+    for lab_name in _LAB_FIELDS:
+        if lab_name in values:
+            patient_data["lab_results"][lab_name] = float(values[lab_name])
     
-    return patient_data 
\ No newline at end of file
+    return patient_data
\ No newline at end of file
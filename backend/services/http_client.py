@@ -0,0 +1,47 @@
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Optional
+from urllib3.util.retry import Retry
+
+# Connection pool settings for outbound API calls
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=30)
+HTTP_TIMEOUT = 30
+
+# Shared HTTP client for outbound API calls, reused across requests so
+# connections (and TLS sessions) stay warm
+_client: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get the process-wide async HTTP client, creating it on first use
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    return _client
+
+async def close_http_client():
+    """
+    Close the shared HTTP client (called on application shutdown)
+    """
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def build_session() -> requests.Session:
+    """
+    Build a requests session that keeps up to 50 connections per host alive and
+    retries transient upstream failures (429 and 5xx) with backoff
+    """
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({"GET", "POST"})
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=50, pool_maxsize=50, max_retries=retries))
+    return session
@@ -1,7 +1,83 @@
-import requests
-import json
-from typing import List, Dict, Any
+import asyncio
+import contextvars
+import httpx
+import logging
+import orjson
+import re
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional, Tuple
 from config import VERTEX_API_KEY
+from services.cache import CRITERION_CACHE, ELIGIBILITY_CACHE, record_cache_lookup, stable_hash
+from services.http_client import build_session
+
+logger = logging.getLogger(__name__)
+
+# Number of trials analyzed together in one Gemini prompt
+ELIGIBILITY_BATCH_SIZE = 8
+
+# A patient is eligible for a trial if they meet more than this percentage of its criteria
+ELIGIBILITY_THRESHOLD = 70.0
+
+# Markdown code fence Gemini sometimes wraps JSON responses in
+_CODE_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+# Gemini response schemas; constrained JSON output is parsed with one orjson.loads
+_VERDICT_PROPERTIES = {
+    "eligible": {"type": "string", "enum": ["YES", "NO"]},
+    "explanation": {"type": "string"},
+    "confidence": {"type": "string", "enum": ["HIGH", "MEDIUM", "LOW"]}
+}
+CRITERION_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": _VERDICT_PROPERTIES,
+    "required": ["eligible", "explanation", "confidence"]
+}
+BATCH_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "trial_id": {"type": "string"},
+            "criteria": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"index": {"type": "integer"}, **_VERDICT_PROPERTIES},
+                    "required": ["index", "eligible", "explanation", "confidence"]
+                }
+            }
+        },
+        "required": ["trial_id", "criteria"]
+    }
+}
+
+# Age bounds in criterion text, e.g. "Age >= 18", "Age 40-65" and "18-65 years". A range
+# must follow the word "age" within the same clause or be followed by "years", so other
+# ranges in the criterion ("NYHA class 2-3") aren't read as ages
+_AGE_MIN_RE = re.compile(r">=\s*(\d+)\s*$")
+_AGE_RANGE_RE = re.compile(r"\bage[ds]?\b[^\d;,.]*(\d+)\s*-\s*(\d+)|(\d+)\s*-\s*(\d+)\s*(?:years?|yrs?)\b")
+
+GEMINI_HEADERS = {
+    "Content-Type": "application/json"
+}
+
+# Pooled session so back-to-back Gemini calls reuse connections
+_SESSION = build_session()
+
+# Per-criterion Gemini calls are network-bound, so they run concurrently on a shared pool
+_GEMINI_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="gemini")
+
+# Whole-trial prompts get their own pool; their per-criterion fallbacks use the one above
+_TRIAL_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="gemini-trial")
+
+def submit_in_context(executor: ThreadPoolExecutor, fn, *args) -> Future:
+    """
+    Submit fn to a pool in a copy of the caller's context
+    
+    ThreadPoolExecutor doesn't carry contextvars over, so without this, logging from
+    pool threads would miss the workflow's trace and start a W&B run per call.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
 
 def run_eligibility_analysis(patient_data: Dict[str, Any], trials: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
@@ -9,44 +85,137 @@ def run_eligibility_analysis(patient_data: Dict[str, Any], trials: List[Dict[str
     """
     try:
         results = []
+        patient_key = stable_hash(patient_data)
+        hits, misses = [], []
         
+        # Reuse recent verdicts, and analyze the other trials concurrently (one prompt each)
+        pending = []
         for trial in trials:
-            # Analyze eligibility for each trial
-            trial_result = analyze_trial_eligibility(patient_data, trial)
+            cache_key = eligibility_cache_key(patient_key, trial)
+            cached_result = ELIGIBILITY_CACHE.get(cache_key)
+            if cached_result is not None:
+                hits.append(cache_key)
+                pending.append((cache_key, cached_result, None))
+            else:
+                misses.append(cache_key)
+                pending.append((cache_key, None, submit_in_context(_TRIAL_EXECUTOR, analyze_trial_eligibility_batched, patient_data, trial)))
+        
+        for cache_key, trial_result, future in pending:
+            if trial_result is None:
+                trial_result = future.result()
+                cache_eligibility_result(cache_key, trial_result)
             results.append(trial_result)
         
+        record_cache_lookup("eligibility", hits, misses)
         return results
         
-    except Exception as e:
-        print(f"Error running eligibility analysis with Vertex AI: {str(e)}")
+    except Exception:
+        logger.warning("Error running eligibility analysis with Vertex AI", exc_info=True)
         # Return mock analysis as fallback
         return get_mock_eligibility_analysis(patient_data, trials)
 
+def eligibility_cache_key(patient_key: str, trial: Dict[str, Any]) -> str:
+    """
+    Build the eligibility cache key for a patient hash and trial
+    """
+    return f"elig:{patient_key}:{trial['trial_id']}"
+
+def cache_eligibility_result(cache_key: str, trial_result: Dict[str, Any]):
+    """
+    Cache a trial's eligibility result unless any criterion fell back to rule-based analysis
+    """
+    if all(c.get("analyzed_by") == "gemini" for c in trial_result["criteria"]):
+        ELIGIBILITY_CACHE.set(cache_key, trial_result)
+
 def analyze_trial_eligibility(patient_data: Dict[str, Any], trial: Dict[str, Any]) -> Dict[str, Any]:
     """
     Analyze patient eligibility for a specific trial using Gemini with 70% threshold
+    
+    Once enough criteria have failed that the threshold can't be reached, criteria
+    still queued are cancelled and reported as not evaluated.
+    """
+    # Analyze each criterion using Gemini, concurrently
+    futures = submit_criteria_analysis(patient_data, trial)
+    failed = 0
+    for future in as_completed(futures):
+        if not future.result()["eligible"]:
+            failed += 1
+            if (len(futures) - failed) / len(futures) * 100 <= ELIGIBILITY_THRESHOLD:
+                for pending in futures:
+                    pending.cancel()
+                break
+    
+    criteria_results = [
+        not_evaluated_result(criterion) if future.cancelled() else future.result()
+        for criterion, future in zip(trial.get("eligibility_criteria", []), futures)
+    ]
+    
+    return build_trial_result(trial, criteria_results)
+
+def not_evaluated_result(criterion: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Result for a criterion skipped because the trial's eligibility was already decided
+    """
+    return {
+        "criterion": criterion["criterion"],
+        "type": criterion["type"],
+        "eligible": False,
+        "explanation": "Not evaluated; enough other criteria were unmet",
+        "confidence": "LOW",
+        "analyzed_by": "not_evaluated"
+    }
+
+def analyze_trial_eligibility_batched(patient_data: Dict[str, Any], trial: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Analyze all of a trial's criteria with a single Gemini prompt
+    
+    Falls back to per-criterion calls if the batched response can't be used.
     """
-    criteria_results = []
+    return analyze_trials_with_gemini(patient_data, [trial])[0]
+
+def submit_criteria_analysis(patient_data: Dict[str, Any], trial: Dict[str, Any]) -> List[Future]:
+    """
+    Queue every criterion of a trial for Gemini analysis on the shared thread pool
+    
+    Exclusion criteria are queued first, since they most often rule a patient out;
+    the futures are returned in the trial's criteria order.
+    """
+    ctx = build_patient_context(patient_data)
+    criteria = trial.get("eligibility_criteria", [])
+    futures = [None] * len(criteria)
+    for index in sorted(range(len(criteria)), key=lambda i: criteria[i]["type"] != "exclusion"):
+        futures[index] = submit_in_context(_GEMINI_EXECUTOR, analyze_single_criterion, patient_data, criteria[index], trial, ctx)
+    return futures
+
+def build_trial_result(trial: Dict[str, Any], criteria_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Build a trial's eligibility result from its analyzed criteria (70% threshold)
     
-    for criterion in trial.get("eligibility_criteria", []):
-        # Analyze each criterion using Gemini
-        eligibility_result = analyze_single_criterion(patient_data, criterion, trial)
-        criteria_results.append(eligibility_result)
+    The percentages cover the criteria that were evaluated (criteria_evaluated of them).
+    """
+    # Criteria skipped once the trial was already decided don't count toward the percentage
+    evaluated = [c for c in criteria_results if c.get("analyzed_by") != "not_evaluated"]
     
     # Calculate eligibility percentage
-    if not criteria_results:
+    if not evaluated:
         overall_eligible = False
         eligibility_percentage = 0
         match_percentage = 0
     else:
         # Count met criteria
-        met_criteria = sum(1 for c in criteria_results if c.get("eligible", False))
-        total_criteria = len(criteria_results)
+        met_criteria = sum(1 for c in evaluated if c.get("eligible", False))
+        total_criteria = len(evaluated)
         eligibility_percentage = (met_criteria / total_criteria) * 100
         match_percentage = int(eligibility_percentage)
         
-        # Patient is eligible if they meet more than 70% of criteria
-        overall_eligible = eligibility_percentage > 70.0
+        # Patient is eligible if they meet more than 70% of criteria; criteria are only
+        # skipped once that can no longer happen
+        overall_eligible = eligibility_percentage > ELIGIBILITY_THRESHOLD and len(evaluated) == len(criteria_results)
+    
+    eligibility_summary = generate_eligibility_summary_with_percentage(evaluated, overall_eligible, eligibility_percentage)
+    skipped = len(criteria_results) - len(evaluated)
+    if skipped:
+        eligibility_summary += f" {skipped} more not evaluated."
     
     return {
         "trial_id": trial["trial_id"],
@@ -55,44 +224,112 @@ def analyze_trial_eligibility(patient_data: Dict[str, Any], trial: Dict[str, Any
         "overall_eligible": overall_eligible,
         "eligibility_percentage": eligibility_percentage,
         "match_percentage": match_percentage,
-        "eligibility_summary": generate_eligibility_summary_with_percentage(criteria_results, overall_eligible, eligibility_percentage)
+        "criteria_evaluated": len(evaluated),
+        "eligibility_summary": eligibility_summary
     }
 
-def analyze_single_criterion(patient_data: Dict[str, Any], criterion: Dict[str, str], trial: Dict[str, Any]) -> Dict[str, Any]:
+def criterion_identity(criterion: Dict[str, str]) -> Tuple[str, str]:
+    """
+    Key under which identical criteria (same type and text) share one verdict
+    """
+    return (criterion["type"], criterion["criterion"])
+
+def criterion_cache_key(patient_key: str, criterion: Dict[str, str]) -> str:
+    """
+    Build the criterion cache key for a patient hash and criterion text/type
+    """
+    return f"crit:{patient_key}:{stable_hash(criterion_identity(criterion))}"
+
+def cache_criterion_result(patient_key: str, criterion_result: Dict[str, Any]):
+    """
+    Cache a single criterion verdict if it came from Gemini
+    """
+    if criterion_result.get("analyzed_by") == "gemini":
+        CRITERION_CACHE.set(criterion_cache_key(patient_key, criterion_result), criterion_result)
+
+def analyze_single_criterion(patient_data: Dict[str, Any], criterion: Dict[str, str], trial: Dict[str, Any], ctx: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     Analyze a single eligibility criterion using Gemini
+    
+    Verdicts are cached per patient and criterion text, so a criterion repeated
+    across trials is only sent to Gemini once. Pass a context from
+    build_patient_context when analyzing many criteria for one patient.
     """
+    if ctx is None:
+        ctx = build_patient_context(patient_data)
+    patient_key = ctx["key"]
+    cached_result = get_cached_criterion_result(patient_key, criterion)
+    if cached_result is not None:
+        return cached_result
+    
     # Create prompt for Gemini
-    prompt = create_eligibility_prompt(patient_data, criterion, trial)
+    prompt = create_eligibility_prompt(ctx["prompt_block"], criterion, trial)
     
     try:
         # Call Gemini API
-        gemini_response = call_gemini_api(prompt)
+        gemini_response = call_gemini_api(prompt, response_schema=CRITERION_RESPONSE_SCHEMA)
         
         # Parse response
         eligibility_result = parse_gemini_response(gemini_response, criterion)
+        cache_criterion_result(patient_key, eligibility_result)
+        
+        return eligibility_result
         
+    except Exception:
+        logger.warning("Error analyzing criterion with Gemini", exc_info=True)
+        # Fallback to rule-based analysis
+        return fallback_criterion_analysis(patient_data, criterion, ctx)
+
+async def analyze_single_criterion_async(patient_data: Dict[str, Any], criterion: Dict[str, str], trial: Dict[str, Any], client: httpx.AsyncClient, ctx: Optional[Dict[str, Any]] = None, semaphore: Optional[asyncio.Semaphore] = None) -> Dict[str, Any]:
+    """
+    Analyze a single eligibility criterion using Gemini over the given async client
+    
+    If a semaphore is given, the Gemini request holds it while in flight.
+    """
+    if ctx is None:
+        ctx = build_patient_context(patient_data)
+    patient_key = ctx["key"]
+    cached_result = get_cached_criterion_result(patient_key, criterion)
+    if cached_result is not None:
+        return cached_result
+    
+    prompt = create_eligibility_prompt(ctx["prompt_block"], criterion, trial)
+    
+    try:
+        gemini_response = await call_gemini_api_async(prompt, client, response_schema=CRITERION_RESPONSE_SCHEMA, semaphore=semaphore)
+        eligibility_result = parse_gemini_response(gemini_response, criterion)
+        cache_criterion_result(patient_key, eligibility_result)
         return eligibility_result
         
-    except Exception as e:
-        print(f"Error analyzing criterion with Gemini: {str(e)}")
+    except Exception:
+        logger.warning("Error analyzing criterion with Gemini", exc_info=True)
         # Fallback to rule-based analysis
-        return fallback_criterion_analysis(patient_data, criterion)
+        return fallback_criterion_analysis(patient_data, criterion, ctx)
 
-def create_eligibility_prompt(patient_data: Dict[str, Any], criterion: Dict[str, str], trial: Dict[str, Any]) -> str:
+def get_cached_criterion_result(patient_key: str, criterion: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    """
+    Get a cached verdict for a criterion, recording the lookup
+    """
+    cache_key = criterion_cache_key(patient_key, criterion)
+    cached_result = CRITERION_CACHE.get(cache_key)
+    if cached_result is not None:
+        record_cache_lookup("criterion", [cache_key], [])
+    else:
+        record_cache_lookup("criterion", [], [cache_key])
+    return cached_result
+
+def create_eligibility_prompt(patient_block: str, criterion: Dict[str, str], trial: Dict[str, Any]) -> str:
     """
     Create a prompt for Gemini to analyze eligibility
+    
+    patient_block is the patient section from format_patient_information, rendered
+    once per request.
     """
     prompt = f"""
 You are a clinical trial eligibility expert. Analyze whether a patient meets a specific eligibility criterion.
 
 PATIENT INFORMATION:
-- Name: {patient_data.get('name', 'Unknown')}
-- Age: {patient_data.get('age', 'Unknown')}
-- Allergies: {', '.join(patient_data.get('allergies', []))}
-- Medical Conditions: {', '.join(patient_data.get('existing_conditions', []))}
-- Lab Results: {json.dumps(patient_data.get('lab_results', {}))}
-- Summary: {patient_data.get('summary', 'No summary available')}
+{patient_block}
 
 TRIAL INFORMATION:
 - Trial ID: {trial['trial_id']}
@@ -110,23 +347,285 @@ INSTRUCTIONS:
 4. Consider the criterion type (inclusion vs exclusion)
 
 RESPONSE FORMAT:
-ELIGIBLE: [YES/NO]
-EXPLANATION: [Brief explanation]
-CONFIDENCE: [HIGH/MEDIUM/LOW]
+Respond with only a JSON object:
+{{"eligible": "YES", "explanation": "Brief explanation", "confidence": "HIGH"}}
+"""
+    
+    return prompt
+
+def format_patient_information(patient_data: Dict[str, Any]) -> str:
+    """
+    Format the patient section shared by all eligibility prompts
+    """
+    return f"""- Name: {patient_data.get('name', 'Unknown')}
+- Age: {patient_data.get('age', 'Unknown')}
+- Allergies: {', '.join(patient_data.get('allergies', []))}
+- Medical Conditions: {', '.join(patient_data.get('existing_conditions', []))}
+- Lab Results: {orjson.dumps(patient_data.get('lab_results', {})).decode()}
+- Summary: {patient_data.get('summary', 'No summary available')}"""
+
+def analyze_trials_batch(patient_data: Dict[str, Any], trials: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Analyze eligibility for several trials, reusing cached verdicts and sending
+    the remaining trials to Gemini in a single call
+    """
+    cache_keys, results_by_id, uncached_trials = lookup_cached_trial_results(patient_data, trials)
+    
+    if uncached_trials:
+        for trial_result in analyze_trials_with_gemini(patient_data, uncached_trials):
+            cache_eligibility_result(cache_keys[trial_result["trial_id"]], trial_result)
+            results_by_id[trial_result["trial_id"]] = trial_result
+    
+    return [results_by_id[trial["trial_id"]] for trial in trials]
+
+async def analyze_trials_batch_async(patient_data: Dict[str, Any], trials: List[Dict[str, Any]], client: httpx.AsyncClient, semaphore: Optional[asyncio.Semaphore] = None) -> List[Dict[str, Any]]:
+    """
+    Async version of analyze_trials_batch that calls Gemini over the given client
+    
+    Every Gemini request made for the batch (including per-criterion fallbacks)
+    holds the semaphore, if given, while in flight.
+    """
+    cache_keys, results_by_id, uncached_trials = lookup_cached_trial_results(patient_data, trials)
+    
+    if uncached_trials:
+        for trial_result in await analyze_trials_with_gemini_async(patient_data, uncached_trials, client, semaphore):
+            cache_eligibility_result(cache_keys[trial_result["trial_id"]], trial_result)
+            results_by_id[trial_result["trial_id"]] = trial_result
+    
+    return [results_by_id[trial["trial_id"]] for trial in trials]
+
+def lookup_cached_trial_results(patient_data: Dict[str, Any], trials: List[Dict[str, Any]]):
+    """
+    Split trials into cached results (keyed by trial ID) and trials still to analyze
+    
+    Returns the cache keys by trial ID, the cached results and the uncached trials.
+    """
+    patient_key = stable_hash(patient_data)
+    cache_keys = {trial["trial_id"]: eligibility_cache_key(patient_key, trial) for trial in trials}
+    results_by_id = {}
+    uncached_trials = []
+    
+    for trial in trials:
+        cached_result = ELIGIBILITY_CACHE.get(cache_keys[trial["trial_id"]])
+        if cached_result is not None:
+            results_by_id[trial["trial_id"]] = cached_result
+        else:
+            uncached_trials.append(trial)
+    
+    record_cache_lookup(
+        "eligibility",
+        [cache_keys[trial_id] for trial_id in results_by_id],
+        [cache_keys[trial["trial_id"]] for trial in uncached_trials]
+    )
+    
+    return cache_keys, results_by_id, uncached_trials
+
+def analyze_trials_with_gemini(patient_data: Dict[str, Any], trials: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Analyze eligibility for several trials with a single Gemini call
+    
+    Criteria missing from the response are analyzed individually, and trials are
+    analyzed criterion-by-criterion if the batched call fails entirely.
+    """
+    ctx = build_patient_context(patient_data)
+    try:
+        prompt = create_batch_eligibility_prompt(ctx["prompt_block"], trials)
+        gemini_response = call_gemini_api(
+            prompt,
+            max_output_tokens=batch_output_tokens(trials),
+            response_schema=BATCH_RESPONSE_SCHEMA
+        )
+        verdicts = parse_batch_gemini_response(gemini_response)
+    except Exception:
+        logger.warning("Error analyzing trial batch with Gemini", exc_info=True)
+        return [analyze_trial_eligibility(patient_data, trial) for trial in trials]
+    
+    trial_criteria = apply_batch_verdicts(trials, verdicts, ctx["key"])
+    for trial, criteria_results in zip(trials, trial_criteria):
+        for index, criterion in enumerate(trial.get("eligibility_criteria", [])):
+            if criteria_results[index] is None:
+                criteria_results[index] = analyze_single_criterion(patient_data, criterion, trial, ctx)
+    
+    return [build_trial_result(trial, criteria_results) for trial, criteria_results in zip(trials, trial_criteria)]
+
+async def analyze_trials_with_gemini_async(patient_data: Dict[str, Any], trials: List[Dict[str, Any]], client: httpx.AsyncClient, semaphore: Optional[asyncio.Semaphore] = None) -> List[Dict[str, Any]]:
+    """
+    Async version of analyze_trials_with_gemini; fallback per-criterion calls run
+    concurrently on the client (multiplexed over HTTP/2)
+    """
+    ctx = build_patient_context(patient_data)
+    try:
+        prompt = create_batch_eligibility_prompt(ctx["prompt_block"], trials)
+        gemini_response = await call_gemini_api_async(
+            prompt,
+            client,
+            max_output_tokens=batch_output_tokens(trials),
+            response_schema=BATCH_RESPONSE_SCHEMA,
+            semaphore=semaphore
+        )
+        verdicts = parse_batch_gemini_response(gemini_response)
+    except Exception:
+        logger.warning("Error analyzing trial batch with Gemini", exc_info=True)
+        verdicts = {}
+    
+    trial_criteria = apply_batch_verdicts(trials, verdicts, ctx["key"])
+    
+    # Analyze each distinct missing criterion once, then fan the result back out
+    missing = {}
+    for trial, criteria_results in zip(trials, trial_criteria):
+        for index, criterion in enumerate(trial.get("eligibility_criteria", [])):
+            if criteria_results[index] is None:
+                missing.setdefault(criterion_identity(criterion), (criterion, trial, []))[2].append((criteria_results, index))
+    analyzed = await asyncio.gather(*(
+        analyze_single_criterion_async(patient_data, criterion, trial, client, ctx, semaphore)
+        for criterion, trial, _ in missing.values()
+    ))
+    for (_, _, positions), criterion_result in zip(missing.values(), analyzed):
+        for criteria_results, index in positions:
+            criteria_results[index] = criterion_result
+    
+    return [build_trial_result(trial, criteria_results) for trial, criteria_results in zip(trials, trial_criteria)]
+
+def batch_output_tokens(trials: List[Dict[str, Any]]) -> int:
+    """
+    Output token budget for a batched prompt (roughly 100 tokens per verdict)
+    """
+    total_criteria = sum(len(trial.get("eligibility_criteria", [])) for trial in trials)
+    return min(8192, 200 + 100 * total_criteria)
+
+def apply_batch_verdicts(trials: List[Dict[str, Any]], verdicts: Dict[str, Dict[int, Dict[str, Any]]], patient_key: str) -> List[List[Optional[Dict[str, Any]]]]:
+    """
+    Turn batched verdicts into per-trial criteria results, caching each verdict
+    
+    Repeated criteria reuse the verdict given for their first occurrence (the
+    prompt lists them once). Criteria without a verdict are left as None for the
+    caller to analyze individually.
+    """
+    trial_criteria = []
+    first_verdicts = {}
+    for trial in trials:
+        trial_verdicts = verdicts.get(trial["trial_id"], {})
+        criteria_results = []
+        for index, criterion in enumerate(trial.get("eligibility_criteria", [])):
+            verdict = trial_verdicts.get(index)
+            if verdict is None:
+                verdict = first_verdicts.get(criterion_identity(criterion))
+            else:
+                first_verdicts.setdefault(criterion_identity(criterion), verdict)
+            if verdict is None:
+                criteria_results.append(None)
+            else:
+                criterion_result = verdict_to_result(verdict, criterion)
+                cache_criterion_result(patient_key, criterion_result)
+                criteria_results.append(criterion_result)
+        trial_criteria.append(criteria_results)
+    return trial_criteria
+
+def create_batch_eligibility_prompt(patient_block: str, trials: List[Dict[str, Any]]) -> str:
+    """
+    Create a prompt for Gemini to analyze every criterion of several trials at once
+    
+    A criterion repeated within the batch is only listed the first time it appears;
+    apply_batch_verdicts copies that verdict to the repeats.
+    """
+    trial_sections = []
+    listed = set()
+    for trial in trials:
+        criteria_lines = []
+        for index, criterion in enumerate(trial.get("eligibility_criteria", [])):
+            identity = criterion_identity(criterion)
+            if identity not in listed:
+                listed.add(identity)
+                criteria_lines.append(f"  {index}. ({criterion['type']}) {criterion['criterion']}")
+        criteria_lines = "\n".join(criteria_lines) or "  (all criteria listed under earlier trials)"
+        trial_sections.append(
+            f"TRIAL {trial['trial_id']}: {trial['title']}\n"
+            f"Conditions: {', '.join(trial.get('conditions', []))}\n"
+            f"Criteria:\n{criteria_lines}"
+        )
+    trials_text = "\n\n".join(trial_sections)
+    
+    prompt = f"""
+You are a clinical trial eligibility expert. Analyze whether a patient meets each eligibility criterion of several clinical trials.
+
+PATIENT INFORMATION:
+{patient_block}
+
+TRIALS:
+{trials_text}
+
+INSTRUCTIONS:
+1. For every numbered criterion of every trial, analyze if the patient meets it
+2. Provide a clear YES or NO answer
+3. Give a brief explanation (1-2 sentences)
+4. Consider the criterion type (inclusion vs exclusion)
+
+RESPONSE FORMAT:
+Respond with only a JSON array containing one object per trial:
+[{{"trial_id": "NCT...", "criteria": [{{"index": 0, "eligible": "YES", "explanation": "Brief explanation", "confidence": "HIGH"}}]}}]
 """
     
     return prompt
 
-def call_gemini_api(prompt: str) -> str:
+def parse_batch_gemini_response(response_text: str) -> Dict[str, Dict[int, Dict[str, Any]]]:
+    """
+    Parse a batched Gemini response into verdicts keyed by trial ID and criterion index
+    """
+    # Strip markdown code fences if Gemini added them
+    text = _CODE_FENCE_RE.sub("", response_text.strip())
+    
+    verdicts = {}
+    for trial_verdict in orjson.loads(text):
+        verdicts[trial_verdict["trial_id"]] = {
+            int(c["index"]): c for c in trial_verdict.get("criteria", []) if "index" in c
+        }
+    
+    return verdicts
+
+def call_gemini_api(prompt: str, max_output_tokens: int = 500, response_schema: Optional[Dict[str, Any]] = None) -> str:
     """
     Call the Vertex AI Gemini API
+    
+    With a response schema, Gemini is constrained to return matching JSON.
     """
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={VERTEX_API_KEY}"
+    data = build_gemini_request(prompt, max_output_tokens, response_schema)
     
-    headers = {
-        "Content-Type": "application/json"
-    }
+    response = _SESSION.post(gemini_api_url(), headers=GEMINI_HEADERS, data=orjson.dumps(data), timeout=30)
+    response.raise_for_status()
+    
+    result = orjson.loads(response.content)
+    return result["candidates"][0]["content"]["parts"][0]["text"]
+
+async def call_gemini_api_async(prompt: str, client: httpx.AsyncClient, max_output_tokens: int = 500, response_schema: Optional[Dict[str, Any]] = None, semaphore: Optional[asyncio.Semaphore] = None) -> str:
+    """
+    Call the Vertex AI Gemini API using the given async client
+    
+    The request holds the semaphore (if given) while in flight, which is how callers
+    bound concurrent Gemini requests.
+    """
+    data = build_gemini_request(prompt, max_output_tokens, response_schema)
+    
+    # Branch explicitly; nullcontext only works with async with from Python 3.10
+    if semaphore is None:
+        response = await client.post(gemini_api_url(), headers=GEMINI_HEADERS, content=orjson.dumps(data))
+    else:
+        async with semaphore:
+            response = await client.post(gemini_api_url(), headers=GEMINI_HEADERS, content=orjson.dumps(data))
+    response.raise_for_status()
     
+    result = orjson.loads(response.content)
+    return result["candidates"][0]["content"]["parts"][0]["text"]
+
+def gemini_api_url() -> str:
+    """
+    Gemini generateContent endpoint, including the API key
+    """
+    return f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent?key={VERTEX_API_KEY}"
+
+def build_gemini_request(prompt: str, max_output_tokens: int, response_schema: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Build the generateContent request body for a prompt
+    """
     data = {
         "contents": [{
             "parts": [{
@@ -135,85 +634,95 @@ def call_gemini_api(prompt: str) -> str:
         }],
         "generationConfig": {
             "temperature": 0.1,
-            "maxOutputTokens": 500
+            "maxOutputTokens": max_output_tokens
         }
     }
-    
-    response = requests.post(url, headers=headers, json=data, timeout=30)
-    response.raise_for_status()
-    
-    result = response.json()
-    return result["candidates"][0]["content"]["parts"][0]["text"]
+    if response_schema is not None:
+        data["generationConfig"]["responseMimeType"] = "application/json"
+        data["generationConfig"]["responseSchema"] = response_schema
+    return data
 
 def parse_gemini_response(response_text: str, criterion: Dict[str, str]) -> Dict[str, Any]:
     """
-    Parse Gemini's response to extract eligibility decision
+    Parse Gemini's JSON response to extract eligibility decision
     """
-    # Extract eligible status
-    eligible = False
-    explanation = "Unable to determine eligibility"
-    confidence = "LOW"
-    
-    lines = response_text.split('\n')
-    
-    for line in lines:
-        line = line.strip()
-        if line.startswith("ELIGIBLE:"):
-            eligible_text = line.split(":", 1)[1].strip().upper()
-            eligible = eligible_text == "YES"
-        elif line.startswith("EXPLANATION:"):
-            explanation = line.split(":", 1)[1].strip()
-        elif line.startswith("CONFIDENCE:"):
-            confidence = line.split(":", 1)[1].strip().upper()
+    # Strip markdown code fences if Gemini added them
+    verdict = orjson.loads(_CODE_FENCE_RE.sub("", response_text.strip()))
     
+    return verdict_to_result(verdict, criterion)
+
+def verdict_to_result(verdict: Dict[str, Any], criterion: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Convert one Gemini verdict object into a criterion result
+    """
     return {
         "criterion": criterion["criterion"],
         "type": criterion["type"],
-        "eligible": eligible,
-        "explanation": explanation,
-        "confidence": confidence,
+        "eligible": str(verdict.get("eligible", "")).upper() == "YES",
+        "explanation": verdict.get("explanation", "Unable to determine eligibility"),
+        "confidence": str(verdict.get("confidence", "LOW")).upper(),
         "analyzed_by": "gemini"
     }
 
-def fallback_criterion_analysis(patient_data: Dict[str, Any], criterion: Dict[str, str]) -> Dict[str, Any]:
+def build_patient_context(patient_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Prepare the per-request view of a patient: its cache key, the rendered prompt
+    section, and the fields used by the rule-based checks (lowercased once)
+    """
+    return {
+        "key": stable_hash(patient_data),
+        "prompt_block": format_patient_information(patient_data),
+        "age": patient_data.get("age"),
+        "allergies": patient_data.get("allergies", []),
+        "allergies_lc": frozenset(a.lower() for a in patient_data.get("allergies", [])),
+        "conditions": patient_data.get("existing_conditions", []),
+        "conditions_lc": tuple(c.lower() for c in patient_data.get("existing_conditions", []))
+    }
+
+def fallback_criterion_analysis(patient_data: Dict[str, Any], criterion: Dict[str, str], ctx: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
     Fallback rule-based analysis if Gemini fails
+    
+    Pass a context from build_patient_context when checking many criteria for one patient.
     """
+    if ctx is None:
+        ctx = build_patient_context(patient_data)
     eligible = True
     explanation = "Analyzed using rule-based fallback"
     
     criterion_text = criterion["criterion"].lower()
     
     # Age-based criteria
-    if "age" in criterion_text and patient_data.get("age"):
-        age = patient_data["age"]
+    if "age" in criterion_text and ctx["age"]:
+        age = ctx["age"]
         if ">=" in criterion_text:
-            try:
-                min_age = int(criterion_text.split(">=")[-1].strip())
+            match = _AGE_MIN_RE.search(criterion_text)
+            if match:
+                min_age = int(match.group(1))
                 eligible = age >= min_age
                 explanation = f"Patient age ({age}) vs minimum age ({min_age})"
-            except:
-                pass
-        elif "40-65" in criterion_text:
-            eligible = 40 <= age <= 65
-            explanation = f"Patient age ({age}) vs required range (40-65)"
+        else:
+            match = _AGE_RANGE_RE.search(criterion_text)
+            if match:
+                # Groups 1-2 hold an "age N-M" range, groups 3-4 an "N-M years" range
+                bounds = match.groups()[:2] if match.group(1) else match.groups()[2:]
+                min_age, max_age = int(bounds[0]), int(bounds[1])
+                eligible = min_age <= age <= max_age
+                explanation = f"Patient age ({age}) vs required range ({min_age}-{max_age})"
     
     # Allergy-based criteria
-    elif "allergy" in criterion_text and patient_data.get("allergies"):
-        allergies = [a.lower() for a in patient_data["allergies"]]
-        if "penicillin" in criterion_text.lower():
-            eligible = "penicillin" not in allergies
-            explanation = f"Patient allergies: {', '.join(patient_data['allergies'])}"
+    elif "allergy" in criterion_text and ctx["allergies"]:
+        if "penicillin" in criterion_text:
+            eligible = "penicillin" not in ctx["allergies_lc"]
+            explanation = f"Patient allergies: {', '.join(ctx['allergies'])}"
     
     # Condition-based criteria
-    elif any(condition in criterion_text for condition in ["diabetes", "cancer", "kidney"]):
-        conditions = [c.lower() for c in patient_data.get("existing_conditions", [])]
-        if "diabetes" in criterion_text:
-            eligible = any("diabetes" in c for c in conditions)
-            explanation = f"Patient conditions: {', '.join(patient_data.get('existing_conditions', []))}"
-        elif "cancer" in criterion_text and criterion["type"] == "exclusion":
-            eligible = not any("cancer" in c for c in conditions)
-            explanation = f"No cancer history found in patient conditions"
+    elif "diabetes" in criterion_text:
+        eligible = any("diabetes" in c for c in ctx["conditions_lc"])
+        explanation = f"Patient conditions: {', '.join(ctx['conditions'])}"
+    elif "cancer" in criterion_text and criterion["type"] == "exclusion":
+        eligible = not any("cancer" in c for c in ctx["conditions_lc"])
+        explanation = f"No cancer history found in patient conditions"
     
     return {
         "criterion": criterion["criterion"],
@@ -253,6 +762,7 @@ def get_mock_eligibility_analysis(patient_data: Dict[str, Any], trials: List[Dic
     Return mock eligibility analysis as fallback with 70% threshold
     """
     results = []
+    has_cancer_history = "cancer" in patient_data.get("summary", "").lower()
     
     for trial in trials:
         criteria_results = []
@@ -261,14 +771,15 @@ def get_mock_eligibility_analysis(patient_data: Dict[str, Any], trials: List[Dic
             eligible = True
             explanation = "Mock analysis"
             
-            if crit["type"] == "exclusion" and "cancer" in patient_data.get("summary", "").lower():
+            if crit["type"] == "exclusion" and has_cancer_history:
                 eligible = False
                 explanation = "Patient has cancer history"
             elif crit["type"] == "inclusion" and "age" in crit["criterion"].lower():
                 if patient_data.get("age"):
                     age = patient_data["age"]
-                    if ">=" in crit["criterion"]:
-                        min_age = int(crit["criterion"].split(">=")[-1].strip())
+                    min_age_match = _AGE_MIN_RE.search(crit["criterion"])
+                    if min_age_match:
+                        min_age = int(min_age_match.group(1))
                         eligible = age >= min_age
                         explanation = f"Patient age ({age}) vs minimum ({min_age})"
                     elif "40-65" in crit["criterion"]:
@@ -284,29 +795,6 @@ def get_mock_eligibility_analysis(patient_data: Dict[str, Any], trials: List[Dic
                 "analyzed_by": "mock"
             })
         
-        # Calculate eligibility percentage (70% threshold)
-        if not criteria_results:
-            overall_eligible = False
-            eligibility_percentage = 0
-            match_percentage = 0
-        else:
-            met_criteria = sum(1 for c in criteria_results if c.get("eligible", False))
-            total_criteria = len(criteria_results)
-            eligibility_percentage = (met_criteria / total_criteria) * 100
-            match_percentage = int(eligibility_percentage)
-            
-            # Patient is eligible if they meet more than 70% of criteria
-            overall_eligible = eligibility_percentage > 70.0
-        
-        trial_result = {
-            "trial_id": trial["trial_id"],
-            "title": trial["title"],
-            "criteria": criteria_results,
-            "overall_eligible": overall_eligible,
-            "eligibility_percentage": eligibility_percentage,
-            "match_percentage": match_percentage,
-            "eligibility_summary": generate_eligibility_summary_with_percentage(criteria_results, overall_eligible, eligibility_percentage)
-        }
-        results.append(trial_result)
+        results.append(build_trial_result(trial, criteria_results))
     
     return results 
\ No newline at end of file
@@ -0,0 +1,107 @@
+"""
+Background workflow tasks for Clinical Trial Matching
+Uploads return a task ID immediately; clients poll /a2a/tasks/{task_id} for the result
+"""
+
+import asyncio
+import logging
+import uuid
+from typing import Dict, Any, Optional
+
+from agents.workflow import run_agent_workflow
+from services.cache import WORKFLOW_CACHE
+from tracing.weave_logger import capture_trace, finalize_session, log_error
+
+logger = logging.getLogger(__name__)
+
+# Task status and results, shared with the A2A task endpoints
+TASKS: Dict[str, Dict[str, Any]] = {}
+
+# Running asyncio tasks by task ID (also keeps them from being garbage collected)
+_RUNNING: Dict[str, asyncio.Task] = {}
+
+def submit_workflow_task(orchestrator, pdf_path: str, filename: str, cache_key: Optional[str] = None) -> str:
+    """
+    Schedule the ADK workflow for a PDF and return its task ID
+    
+    A successful result is stored under cache_key in the workflow cache.
+    """
+    task_id = str(uuid.uuid4())
+    TASKS[task_id] = {"task_id": task_id, "status": "pending", "filename": filename}
+
+    task = asyncio.create_task(run_workflow_task(task_id, orchestrator, pdf_path, filename, cache_key))
+    _RUNNING[task_id] = task
+    task.add_done_callback(lambda _: _RUNNING.pop(task_id, None))
+
+    return task_id
+
+def add_completed_task(filename: str, workflow_result: Dict[str, Any]) -> str:
+    """
+    Record a task for a cached workflow result and return its task ID
+    """
+    task_id = str(uuid.uuid4())
+    TASKS[task_id] = {
+        "task_id": task_id,
+        "status": "completed",
+        "filename": filename,
+        "result": {
+            "filename": filename,
+            "workflow_result": workflow_result,
+            "agent_system": "Cached result"
+        }
+    }
+    return task_id
+
+async def run_workflow_task(task_id: str, orchestrator, pdf_path: str, filename: str, cache_key: Optional[str] = None):
+    """
+    Run the ADK workflow, falling back to the original workflow if it fails
+    """
+    TASKS[task_id]["status"] = "running"
+
+    trace = None
+    try:
+        response = await orchestrator.run_full_workflow(pdf_path)
+        trace = capture_trace()
+        agent_system = "Google ADK + A2A Protocol"
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.warning("A2A workflow failed, falling back to original workflow", exc_info=True)
+        try:
+            response = await asyncio.to_thread(run_agent_workflow, pdf_path)
+            agent_system = "Fallback - Original Workflow"
+        except Exception as e2:
+            log_error("workflow_task_error", str(e2), {"task_id": task_id, "pdf_path": pdf_path})
+            TASKS[task_id].update({"status": "failed", "error": str(e2)})
+            return
+
+    TASKS[task_id]["result"] = {
+        "filename": filename,
+        "workflow_result": response,
+        "agent_system": agent_system
+    }
+    if response.get("status") == "failed":
+        TASKS[task_id].update({"status": "failed", "error": response.get("error")})
+    else:
+        TASKS[task_id]["status"] = "completed"
+        if cache_key:
+            WORKFLOW_CACHE.set(cache_key, response)
+    
+    # The result is already visible to pollers; flush telemetry afterwards
+    if trace is not None:
+        await asyncio.to_thread(finalize_session, response, trace)
+
+def schedule_finalize(final_results: Dict[str, Any]):
+    """
+    Flush the current workflow's telemetry in a worker thread without waiting for it
+    """
+    trace = capture_trace()
+    asyncio.get_running_loop().run_in_executor(None, finalize_session, final_results, trace)
+
+def cancel_workflow_task(task_id: str):
+    """
+    Stop the workflow for a task if it is still running
+    """
+    task = _RUNNING.get(task_id)
+    if task is not None:
+        task.cancel()
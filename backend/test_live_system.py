@@ -5,282 +5,340 @@ Tests the complete clinical trial matching system with actual HTTP requests
 """
 
 import asyncio
-import json
-import requests
-import time
-from pathlib import Path
+import contextvars
+import functools
+import httpx
+import orjson
+import sys
 
 # Server configuration
 BASE_URL = "http://localhost:8000"
+A2A_URL = f"{BASE_URL}/a2a"
 TIMEOUT = 30
 
-def test_server_health():
+# Connection pool sized above the number of concurrent probes, so none wait for a
+# free connection; failed connection attempts are retried before a probe fails
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=20, keepalive_expiry=30)
+CONNECT_RETRIES = 2
+
+# Task status polling
+POLL_TIMEOUT_SECONDS = 10
+POLL_INITIAL_DELAY_SECONDS = 0.05
+POLL_MAX_DELAY_SECONDS = 1.0
+
+# Agent registry responses by base URL, so discovery hits the server once
+_DISCOVERY_CACHE = {}
+
+# Fields every agent in the discovery list must have; tests read agent metadata
+# from that list rather than calling GET /agents/{agent_id} per agent
+AGENT_METADATA_FIELDS = frozenset({"agent_id", "name", "capabilities"})
+
+# Output lines of the test running in the current task
+_OUTPUT = contextvars.ContextVar("test_output", default=None)
+
+# Static request bodies, serialized once at import
+JSON_HEADERS = {"Content-Type": "application/json"}
+DOC_AGENT_MESSAGE = orjson.dumps({
+    "agent_id": "document_processing_agent",
+    "message": {"role": "user", "data": {"pdf_path": "test_patient.txt"}}
+})
+TRIALS_AGENT_MESSAGE = orjson.dumps({
+    "agent_id": "clinical_trials_agent",
+    "message": {"role": "user", "data": {"patient_data": {"existing_conditions": ["diabetes"]}}}
+})
+WORKFLOW_REQUEST = orjson.dumps({
+    "patient_data": {
+        "age": 65,
+        "gender": "male",
+        "conditions": ["diabetes", "hypertension"],
+        "medications": ["metformin", "lisinopril"],
+        "location": "Boston, MA"
+    },
+    "search_criteria": {
+        "condition": "diabetes",
+        "location": "Boston",
+        "status": "recruiting"
+    }
+})
+
+# Agents messaged by the communication test: (agent_id, icon, label, message body)
+AGENT_PROBES = (
+    ("document_processing_agent", "📄", "Document agent", DOC_AGENT_MESSAGE),
+    ("clinical_trials_agent", "🎯", "Trials agent", TRIALS_AGENT_MESSAGE)
+)
+
+# Sample report uploaded (from memory) by the upload tests to simulate a patient PDF
+SAMPLE_REPORT = """
+Patient Medical Report
+
+Patient: John Doe
+Age: 65
+Gender: Male
+
+Chief Complaint: Diabetes management
+
+Current Medications:
+- Metformin 500mg twice daily
+- Lisinopril 10mg once daily
+
+Medical History:
+- Type 2 Diabetes Mellitus (diagnosed 2018)
+- Hypertension (diagnosed 2020)
+
+Current Status: Stable, seeking clinical trial participation
+"""
+SAMPLE_REPORT_BYTES = SAMPLE_REPORT.encode()
+
+async def fetch_agents(client):
+    """Get the server's agent registry, fetching it only once per base URL"""
+    if BASE_URL not in _DISCOVERY_CACHE:
+        response = await client.get(f"{A2A_URL}/agents", timeout=TIMEOUT)
+        response.raise_for_status()
+        _DISCOVERY_CACHE[BASE_URL] = orjson.loads(response.content)["agents"]
+    return _DISCOVERY_CACHE[BASE_URL]
+
+def agent_metadata_complete(agents):
+    """Check that every discovered agent carries the metadata the tests read"""
+    return all(AGENT_METADATA_FIELDS <= agent.keys() for agent in agents)
+
+def report(message):
+    """Add a line to the running test's output (printed directly outside a test)"""
+    lines = _OUTPUT.get()
+    if lines is None:
+        print(message)
+    else:
+        lines.append(message)
+
+def buffered_output(test):
+    """Write a test's output in one block when it finishes, so concurrent tests don't interleave"""
+    @functools.wraps(test)
+    async def run_test(*args, **kwargs):
+        lines = []
+        token = _OUTPUT.set(lines)
+        try:
+            return await test(*args, **kwargs)
+        finally:
+            _OUTPUT.reset(token)
+            sys.stdout.write("\n".join(lines) + "\n")
+    return run_test
+
+@buffered_output
+async def test_server_health(client):
     """Test if the server is running and responsive"""
-    print("🏥 Testing Server Health...")
+    report("\n🏥 Testing Server Health...")
     try:
-        response = requests.get(f"{BASE_URL}/", timeout=5)
+        response = await client.get(f"{BASE_URL}/health", timeout=5)
         if response.status_code == 200:
-            print("✅ Server is running and responsive")
+            report("✅ Server is running and responsive")
             return True
         else:
-            print(f"❌ Server returned status code: {response.status_code}")
+            report(f"❌ Server returned status code: {response.status_code}")
             return False
-    except Exception as e:
-        print(f"❌ Server health check failed: {e}")
+    except httpx.HTTPError as e:
+        report(f"❌ Server health check failed: {e}")
         return False
 
-def test_agent_discovery():
+@buffered_output
+async def test_agent_discovery(client):
     """Test agent discovery endpoint"""
-    print("\n🔍 Testing Agent Discovery...")
+    report("\n🔍 Testing Agent Discovery...")
     try:
-        response = requests.get(f"{BASE_URL}/agents", timeout=TIMEOUT)
-        if response.status_code == 200:
-            agents = response.json()
-            print(f"✅ Discovered {len(agents)} agents:")
-            for agent in agents:
-                print(f"   - {agent['id']}: {agent['name']}")
-                print(f"     Capabilities: {', '.join(agent['capabilities'])}")
-            return agents
-        else:
-            print(f"❌ Agent discovery failed: {response.status_code}")
+        agents = await fetch_agents(client)
+        if not agent_metadata_complete(agents):
+            report(f"❌ Agent discovery returned agents without {', '.join(sorted(AGENT_METADATA_FIELDS))}")
             return None
-    except Exception as e:
-        print(f"❌ Agent discovery error: {e}")
+        report(f"✅ Discovered {len(agents)} agents:")
+        for agent in agents:
+            report(f"   - {agent['agent_id']}: {agent['name']}")
+            report(f"     Capabilities: {', '.join(agent['capabilities'])}")
+        return agents
+    except httpx.HTTPStatusError as e:
+        report(f"❌ Agent discovery failed: {e.response.status_code}")
+        return None
+    except (httpx.HTTPError, orjson.JSONDecodeError, KeyError) as e:
+        report(f"❌ Agent discovery error: {e}")
         return None
 
-def test_individual_agent_communication(agents):
+@buffered_output
+async def test_individual_agent_communication(client, agents):
     """Test communication with individual agents"""
-    print("\n💬 Testing Individual Agent Communication...")
+    report("\n💬 Testing Individual Agent Communication...")
     
     if not agents:
-        print("❌ No agents available for testing")
+        report("❌ No agents available for testing")
         return False
     
-    # Test document processing agent
-    doc_agent = next((a for a in agents if a['id'] == 'document_processing_agent'), None)
-    if doc_agent:
-        print(f"📄 Testing {doc_agent['name']}...")
-        try:
-            test_message = {
-                "role": "user",
-                "parts": [{"text": "Hello, can you process a medical document?"}]
-            }
-            response = requests.post(
-                f"{BASE_URL}/agents/document_processing_agent/message",
-                json=test_message,
-                timeout=TIMEOUT
-            )
-            if response.status_code == 200:
-                result = response.json()
-                print(f"✅ Document agent responded: {result.get('message', 'No message')[:100]}...")
-            else:
-                print(f"❌ Document agent failed: {response.status_code}")
-        except Exception as e:
-            print(f"❌ Document agent error: {e}")
+    agents_by_id = {agent['agent_id']: agent for agent in agents}
     
-    # Test clinical trials agent
-    trials_agent = next((a for a in agents if a['id'] == 'clinical_trials_agent'), None)
-    if trials_agent:
-        print(f"🎯 Testing {trials_agent['name']}...")
-        try:
-            test_message = {
-                "role": "user",
-                "parts": [{"text": "Search for diabetes clinical trials"}]
-            }
-            response = requests.post(
-                f"{BASE_URL}/agents/clinical_trials_agent/message",
-                json=test_message,
-                timeout=TIMEOUT
-            )
-            if response.status_code == 200:
-                result = response.json()
-                print(f"✅ Trials agent responded: {result.get('message', 'No message')[:100]}...")
-            else:
-                print(f"❌ Trials agent failed: {response.status_code}")
-        except Exception as e:
-            print(f"❌ Trials agent error: {e}")
+    # Message each known agent concurrently
+    await asyncio.gather(*(
+        probe_agent(client, agents_by_id[agent_id], icon, label, body)
+        for agent_id, icon, label, body in AGENT_PROBES
+        if agent_id in agents_by_id
+    ))
     
     return True
 
-def test_workflow_execution():
+async def probe_agent(client, agent, icon, label, body):
+    """Send a test message to one agent and report its reply"""
+    report(f"{icon} Testing {agent['name']}...")
+    try:
+        response = await client.post(
+            f"{A2A_URL}/agents/{agent['agent_id']}/message",
+            content=body,
+            headers=JSON_HEADERS,
+            timeout=TIMEOUT
+        )
+        if response.status_code == 200:
+            result = orjson.loads(response.content)
+            report(f"✅ {label} responded: {str(result.get('message', 'No message'))[:100]}...")
+        else:
+            report(f"❌ {label} failed: {response.status_code}")
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        report(f"❌ {label} error: {e}")
+
+@buffered_output
+async def test_workflow_execution(client):
     """Test complete workflow execution"""
-    print("\n🔄 Testing Complete Workflow Execution...")
+    report("\n🔄 Testing Complete Workflow Execution...")
     
     try:
         # Test workflow with sample patient data
-        workflow_request = {
-            "patient_data": {
-                "age": 65,
-                "gender": "male",
-                "conditions": ["diabetes", "hypertension"],
-                "medications": ["metformin", "lisinopril"],
-                "location": "Boston, MA"
-            },
-            "search_criteria": {
-                "condition": "diabetes",
-                "location": "Boston",
-                "status": "recruiting"
-            }
-        }
-        
-        print("🚀 Starting workflow execution...")
-        response = requests.post(
-            f"{BASE_URL}/workflow/run",
-            json=workflow_request,
+        report("🚀 Starting workflow execution...")
+        response = await client.post(
+            f"{A2A_URL}/workflow/run",
+            content=WORKFLOW_REQUEST,
+            headers=JSON_HEADERS,
             timeout=TIMEOUT
         )
         
         if response.status_code == 200:
-            result = response.json()
+            result = orjson.loads(response.content)
             task_id = result.get('task_id')
-            print(f"✅ Workflow started with task ID: {task_id}")
+            report(f"✅ Workflow started with task ID: {task_id}")
             
             # Monitor task progress
             if task_id:
-                print("⏳ Monitoring task progress...")
-                for i in range(10):  # Check for up to 10 seconds
-                    time.sleep(1)
-                    status_response = requests.get(f"{BASE_URL}/tasks/{task_id}")
+                report("⏳ Monitoring task progress...")
+                # Poll with exponential backoff (50ms doubling up to 1s) for up to 10 seconds
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + POLL_TIMEOUT_SECONDS
+                delay = POLL_INITIAL_DELAY_SECONDS
+                while loop.time() < deadline:
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, POLL_MAX_DELAY_SECONDS)
+                    status_response = await client.get(f"{A2A_URL}/tasks/{task_id}", timeout=TIMEOUT)
                     if status_response.status_code == 200:
-                        status = status_response.json()
-                        print(f"   Status: {status.get('status', 'unknown')}")
+                        status = orjson.loads(status_response.content)
+                        report(f"   Status: {status.get('status', 'unknown')}")
                         if status.get('status') == 'completed':
-                            print(f"✅ Workflow completed successfully!")
-                            print(f"   Result: {status.get('result', {}).get('message', 'No result')[:200]}...")
+                            report(f"✅ Workflow completed successfully!")
+                            report(f"   Result: {status.get('result', {}).get('message', 'No result')[:200]}...")
                             return True
                         elif status.get('status') == 'failed':
-                            print(f"❌ Workflow failed: {status.get('error', 'Unknown error')}")
+                            report(f"❌ Workflow failed: {status.get('error', 'Unknown error')}")
                             return False
                 
-                print("⚠️  Workflow still running after 10 seconds")
+                report("⚠️  Workflow still running after 10 seconds")
                 return True
             else:
-                print("❌ No task ID returned")
+                report("❌ No task ID returned")
                 return False
         else:
-            print(f"❌ Workflow execution failed: {response.status_code}")
-            print(f"   Response: {response.text}")
+            report(f"❌ Workflow execution failed: {response.status_code}")
+            report(f"   Response: {response.text}")
             return False
-    except Exception as e:
-        print(f"❌ Workflow execution error: {e}")
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        report(f"❌ Workflow execution error: {e}")
         return False
 
-def test_pdf_upload_endpoint():
-    """Test PDF upload endpoint (if sample PDF exists)"""
-    print("\n📎 Testing PDF Upload Endpoint...")
-    
-    # Create a sample text file to simulate PDF upload
-    sample_file_path = Path("sample_medical_report.txt")
-    sample_content = """
-    Patient Medical Report
-    
-    Patient: John Doe
-    Age: 65
-    Gender: Male
-    
-    Chief Complaint: Diabetes management
-    
-    Current Medications:
-    - Metformin 500mg twice daily
-    - Lisinopril 10mg once daily
-    
-    Medical History:
-    - Type 2 Diabetes Mellitus (diagnosed 2018)
-    - Hypertension (diagnosed 2020)
-    
-    Current Status: Stable, seeking clinical trial participation
-    """
+@buffered_output
+async def test_pdf_upload_endpoint(client):
+    """Test PDF upload endpoint (by uploading the sample text report)"""
+    report("\n📎 Testing PDF Upload Endpoint...")
     
     try:
-        # Write sample file
-        sample_file_path.write_text(sample_content)
-        
-        # Test upload
-        with open(sample_file_path, 'rb') as f:
-            files = {'file': ('sample_medical_report.txt', f, 'text/plain')}
-            response = requests.post(
-                f"{BASE_URL}/upload-pdf-adk",
-                files=files,
-                timeout=TIMEOUT
-            )
+        files = {'file': ('sample_medical_report.txt', SAMPLE_REPORT_BYTES, 'text/plain')}
+        response = await client.post(
+            f"{BASE_URL}/upload-pdf-adk",
+            files=files,
+            timeout=TIMEOUT
+        )
         
-        if response.status_code == 200:
-            result = response.json()
-            print("✅ PDF upload successful!")
-            print(f"   Analysis: {result.get('analysis', 'No analysis')[:200]}...")
+        if response.status_code in (200, 202):
+            result = orjson.loads(response.content)
+            report("✅ PDF upload accepted!")
+            report(f"   Task ID: {result.get('task_id')}")
             return True
         else:
-            print(f"❌ PDF upload failed: {response.status_code}")
-            print(f"   Response: {response.text}")
+            report(f"❌ PDF upload failed: {response.status_code}")
+            report(f"   Response: {response.text}")
             return False
             
-    except Exception as e:
-        print(f"❌ PDF upload error: {e}")
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
+        report(f"❌ PDF upload error: {e}")
         return False
-    finally:
-        # Clean up
-        if sample_file_path.exists():
-            sample_file_path.unlink()
 
-def test_legacy_endpoints():
+@buffered_output
+async def test_legacy_endpoints(client):
     """Test legacy endpoints for backward compatibility"""
-    print("\n🔄 Testing Legacy Endpoints...")
+    report("\n🔄 Testing Legacy Endpoints...")
     
     # Test original upload endpoint
     try:
-        sample_file_path = Path("legacy_test.txt")
-        sample_content = "Patient with diabetes seeking clinical trials"
-        sample_file_path.write_text(sample_content)
-        
-        with open(sample_file_path, 'rb') as f:
-            files = {'file': ('legacy_test.txt', f, 'text/plain')}
-            response = requests.post(
-                f"{BASE_URL}/upload-pdf",
-                files=files,
-                timeout=TIMEOUT
-            )
+        files = {'file': ('legacy_test.txt', SAMPLE_REPORT_BYTES, 'text/plain')}
+        response = await client.post(
+            f"{BASE_URL}/upload-pdf",
+            files=files,
+            timeout=TIMEOUT
+        )
         
         if response.status_code == 200:
-            print("✅ Legacy upload endpoint working")
+            report("✅ Legacy upload endpoint working")
             return True
         else:
-            print(f"⚠️  Legacy upload endpoint: {response.status_code}")
+            report(f"⚠️  Legacy upload endpoint: {response.status_code}")
             return False
             
-    except Exception as e:
-        print(f"❌ Legacy endpoint error: {e}")
+    except httpx.HTTPError as e:
+        report(f"❌ Legacy endpoint error: {e}")
         return False
-    finally:
-        if sample_file_path.exists():
-            sample_file_path.unlink()
 
-def main():
+async def main():
     """Run all live system tests"""
     print("🚀 LIVE SYSTEM TESTING")
     print("Testing Clinical Trial Matching System with Real HTTP Requests")
     print("=" * 70)
     
-    # Test results
-    results = []
-    
-    # 1. Server Health
-    results.append(("Server Health", test_server_health()))
-    
-    # 2. Agent Discovery
-    agents = test_agent_discovery()
-    results.append(("Agent Discovery", agents is not None))
-    
-    # 3. Individual Agent Communication
-    results.append(("Agent Communication", test_individual_agent_communication(agents)))
-    
-    # 4. Workflow Execution
-    results.append(("Workflow Execution", test_workflow_execution()))
-    
-    # 5. PDF Upload
-    results.append(("PDF Upload", test_pdf_upload_endpoint()))
+    # One keep-alive HTTP/2 client so concurrent probes share connections
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=HTTP_LIMITS, retries=CONNECT_RETRIES)
+    async with httpx.AsyncClient(transport=transport, timeout=TIMEOUT) as client:
+        # Every other probe needs the server, so stop early if it is down
+        health_ok = await test_server_health(client)
+        if not health_ok:
+            print(f"\n❌ Server at {BASE_URL} failed its health check; skipping the remaining tests")
+            return
+        
+        # Independent probes run concurrently
+        agents, workflow_ok, upload_ok, legacy_ok = await asyncio.gather(
+            test_agent_discovery(client),
+            test_workflow_execution(client),
+            test_pdf_upload_endpoint(client),
+            test_legacy_endpoints(client)
+        )
+        
+        # Agent communication needs the discovered agents
+        communication_ok = await test_individual_agent_communication(client, agents)
     
-    # 6. Legacy Endpoints
-    results.append(("Legacy Compatibility", test_legacy_endpoints()))
+    # Test results
+    results = [
+        ("Server Health", health_ok),
+        ("Agent Discovery", agents is not None),
+        ("Agent Communication", communication_ok),
+        ("Workflow Execution", workflow_ok),
+        ("PDF Upload", upload_ok),
+        ("Legacy Compatibility", legacy_ok)
+    ]
     
     # Summary
     print("\n" + "=" * 70)
@@ -309,4 +367,4 @@ def main():
     print("   - Monitor W&B Weave at: https://wandb.ai/your-username/clinical-trial-match")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    asyncio.run(main()) 
\ No newline at end of file
@@ -5,69 +5,155 @@ Tests the complete clinical trial matching system with Google ADK agents and A2A
 """
 
 import asyncio
-import json
-import os
-from pathlib import Path
+import contextvars
+import functools
+import sys
 
-from agents.adk_agents import initialize_adk_agents
-from agents.a2a_server import create_a2a_server, A2ARequest
-from tracing.weave_logger import log_workflow_step
 
+# Phase 2 architecture summary, written in one go after a fully passing run
+ARCHITECTURE_SUMMARY = """
+============================================================
+🏗️  PHASE 2 ARCHITECTURE SUMMARY
+============================================================
 
+📋 IMPLEMENTED COMPONENTS:
+   ✅ Google ADK Agents
+      - DocumentProcessingAgent (PDF parsing)
+      - ClinicalTrialsAgent (trials.gov API)
+      - EligibilityAnalysisAgent (Vertex AI)
+      - ClinicalTrialOrchestrator (workflow coordination)
+
+   ✅ A2A Protocol Integration
+      - Agent discovery and registry
+      - Standardized message format
+      - Agent-to-agent communication
+      - Task tracking and management
+
+   ✅ Function Tools
+      - Custom Python functions as tools
+      - Proper docstring documentation
+      - Type hints and structured returns
+
+   ✅ Enhanced Logging
+      - W&B Weave experiment tracking
+      - Structured workflow logging
+      - Agent communication tracing
+
+🔧 TECHNICAL STACK:
+   - Google ADK 1.6.1+ (Agent Development Kit)
+   - A2A Protocol 0.1.0 (Agent-to-Agent Communication)
+   - FastAPI (REST API framework)
+   - Google Document AI (PDF processing)
+   - Vertex AI Gemini (LLM reasoning)
+   - clinicaltrials.gov API (trial data)
+   - W&B Weave (experiment tracking)
+
+🚀 CAPABILITIES:
+   - Multi-agent workflow orchestration
+   - Standardized agent communication
+   - Agent discovery and routing
+   - Real-time task tracking
+   - Comprehensive experiment logging
+
+📊 ENDPOINTS:
+   - GET /agents (list all agents)
+   - GET /agents/{agent_id} (agent details)
+   - POST /agents/{agent_id}/message (send message)
+   - POST /workflow/run (run complete workflow)
+   - GET /tasks/{task_id} (task status)
+   - POST /upload-pdf-adk (ADK-powered PDF processing)
+"""
+
+
+# Output lines of the test running in the current thread or task
+_OUTPUT = contextvars.ContextVar("test_output", default=None)
+
+
+def report(message):
+    """Add a line to the running test's output (printed directly outside a test)"""
+    lines = _OUTPUT.get()
+    if lines is None:
+        print(message)
+    else:
+        lines.append(message)
+
+
+def buffered_output(test):
+    """Write a test's output in one block when it finishes, so concurrent tests don't interleave"""
+    @functools.wraps(test)
+    def run_test(*args, **kwargs):
+        lines = []
+        token = _OUTPUT.set(lines)
+        try:
+            return test(*args, **kwargs)
+        finally:
+            _OUTPUT.reset(token)
+            sys.stdout.write("\n".join(lines) + "\n")
+    return run_test
+
+
+@buffered_output
 def test_adk_agents_initialization():
     """Test that all ADK agents can be initialized"""
-    print("🔧 Testing ADK Agents Initialization...")
+    report("🔧 Testing ADK Agents Initialization...")
     
     try:
-        agents = initialize_adk_agents()
-        print(f"✅ Successfully initialized {len(agents)} agents:")
+        from agents.registry import get_agents
+        agents = get_agents()
+        report(f"✅ Successfully initialized {len(agents)} agents:")
         for agent_name in agents.keys():
-            print(f"   - {agent_name}")
+            report(f"   - {agent_name}")
         return True
     except Exception as e:
-        print(f"❌ Failed to initialize ADK agents: {e}")
+        report(f"❌ Failed to initialize ADK agents: {e}")
         return False
 
 
+@buffered_output
 def test_a2a_server_creation():
     """Test that A2A Protocol server can be created"""
-    print("\n🌐 Testing A2A Protocol Server Creation...")
+    report("\n🌐 Testing A2A Protocol Server Creation...")
     
     try:
-        server = create_a2a_server()
-        print("✅ A2A Protocol server created successfully")
-        print(f"   - Server has {len(server.agents)} agent types")
+        from agents.a2a_server import create_a2a_server
+        from agents.registry import get_agents
+        server = create_a2a_server(get_agents())
+        report("✅ A2A Protocol server created successfully")
+        report(f"   - Server has {len(server.agents)} agent types")
         return server
     except Exception as e:
-        print(f"❌ Failed to create A2A server: {e}")
+        report(f"❌ Failed to create A2A server: {e}")
         return None
 
 
+@buffered_output
 def test_agent_registry(server):
     """Test the agent registry functionality"""
-    print("\n📝 Testing Agent Registry...")
+    report("\n📝 Testing Agent Registry...")
     
     try:
         from agents.a2a_server import AGENT_REGISTRY
-        print(f"✅ Agent registry contains {len(AGENT_REGISTRY)} agents:")
+        report(f"✅ Agent registry contains {len(AGENT_REGISTRY)} agents:")
         for agent_id, agent_info in AGENT_REGISTRY.items():
-            print(f"   - {agent_id}: {agent_info['name']}")
-            print(f"     Capabilities: {', '.join(agent_info['capabilities'])}")
+            report(f"   - {agent_id}: {agent_info['name']}")
+            report(f"     Capabilities: {', '.join(agent_info['capabilities'])}")
         return True
-    except Exception as e:
-        print(f"❌ Failed to test agent registry: {e}")
+    except (ImportError, KeyError) as e:
+        report(f"❌ Failed to test agent registry: {e}")
         return False
 
 
 async def test_agent_communication(server):
     """Test A2A Protocol agent communication"""
-    print("\n💬 Testing A2A Protocol Agent Communication...")
+    report("\n💬 Testing A2A Protocol Agent Communication...")
+    
+    from agents.a2a_server import A2ARequest
     
     try:
         # Test document processing agent
         doc_message = {
             "role": "user",
-            "parts": [{"type": "text", "text": "pdf_path:test_patient.pdf"}]
+            "data": {"pdf_path": "test_patient.pdf"}
         }
         
         doc_request = A2ARequest(
@@ -76,15 +162,15 @@ async def test_agent_communication(server):
             task_id="test_doc_001"
         )
         
-        print("📄 Testing document processing agent communication...")
+        report("📄 Testing document processing agent communication...")
         # This would normally process a real PDF, but we'll simulate the structure
-        print("   - Message format validated ✅")
-        print("   - Agent routing configured ✅")
+        report("   - Message format validated ✅")
+        report("   - Agent routing configured ✅")
         
         # Test orchestrator message
         orchestrator_message = {
             "role": "user", 
-            "parts": [{"type": "text", "text": "pdf_path:sample_patient.pdf"}]
+            "data": {"pdf_path": "sample_patient.pdf"}
         }
         
         orchestrator_request = A2ARequest(
@@ -93,53 +179,59 @@ async def test_agent_communication(server):
             task_id="test_workflow_001"
         )
         
-        print("🎯 Testing orchestrator agent communication...")
-        print("   - Workflow message format validated ✅")
-        print("   - Agent coordination configured ✅")
+        report("🎯 Testing orchestrator agent communication...")
+        report("   - Workflow message format validated ✅")
+        report("   - Agent coordination configured ✅")
         
         return True
         
-    except Exception as e:
-        print(f"❌ Failed to test agent communication: {e}")
+    except TypeError as e:
+        report(f"❌ Failed to test agent communication: {e}")
         return False
 
 
+@buffered_output
 def test_google_adk_integration():
     """Test Google ADK integration features"""
-    print("\n🔗 Testing Google ADK Integration...")
+    report("\n🔗 Testing Google ADK Integration...")
+    
+    from agents.registry import get_agents
     
     try:
-        agents = initialize_adk_agents()
+        agents = get_agents()
         
         # Test agent structure
         orchestrator = agents["orchestrator"]
-        print("✅ Orchestrator agent structure:")
-        print(f"   - Agent name: {orchestrator.agent.name}")
-        print(f"   - Model: {orchestrator.agent.model}")
-        print(f"   - Tools: {len(orchestrator.agent.tools)} tool(s)")
+        report("✅ Orchestrator agent structure:")
+        report(f"   - Agent name: {orchestrator.agent.name}")
+        report(f"   - Model: {orchestrator.agent.model}")
+        report(f"   - Tools: {len(orchestrator.agent.tools)} tool(s)")
         
         # Test sub-agents
         doc_agent = agents["document_agent"]
         trials_agent = agents["trials_agent"]
         eligibility_agent = agents["eligibility_agent"]
         
-        print("✅ Sub-agents configured:")
-        print(f"   - Document Agent: {doc_agent.agent.name}")
-        print(f"   - Trials Agent: {trials_agent.agent.name}")
-        print(f"   - Eligibility Agent: {eligibility_agent.agent.name}")
+        report("✅ Sub-agents configured:")
+        report(f"   - Document Agent: {doc_agent.agent.name}")
+        report(f"   - Trials Agent: {trials_agent.agent.name}")
+        report(f"   - Eligibility Agent: {eligibility_agent.agent.name}")
         
         return True
         
-    except Exception as e:
-        print(f"❌ Failed to test Google ADK integration: {e}")
+    except (KeyError, AttributeError) as e:
+        report(f"❌ Failed to test Google ADK integration: {e}")
         return False
 
 
+@buffered_output
 def test_weave_logging_integration():
     """Test W&B Weave logging integration"""
-    print("\n📊 Testing W&B Weave Logging Integration...")
+    report("\n📊 Testing W&B Weave Logging Integration...")
     
     try:
+        from tracing.weave_logger import log_workflow_step
+        
         # Test logging functionality
         log_workflow_step("phase2_test", {
             "test_type": "integration_test",
@@ -147,69 +239,48 @@ def test_weave_logging_integration():
             "components": ["ADK Agents", "A2A Protocol", "Agent Registry", "Function Tools"]
         })
         
-        print("✅ W&B Weave logging integration working")
-        print("   - Workflow steps logged ✅")
-        print("   - Structured data format ✅")
+        report("✅ W&B Weave logging integration working")
+        report("   - Workflow steps logged ✅")
+        report("   - Structured data format ✅")
         
         return True
         
     except Exception as e:
-        print(f"❌ Failed to test Weave logging: {e}")
+        report(f"❌ Failed to test Weave logging: {e}")
         return False
 
 
-def display_architecture_summary():
-    """Display the Phase 2 architecture summary"""
-    print("\n" + "="*60)
-    print("🏗️  PHASE 2 ARCHITECTURE SUMMARY")
-    print("="*60)
-    
-    print("\n📋 IMPLEMENTED COMPONENTS:")
-    print("   ✅ Google ADK Agents")
-    print("      - DocumentProcessingAgent (PDF parsing)")
-    print("      - ClinicalTrialsAgent (trials.gov API)")
-    print("      - EligibilityAnalysisAgent (Vertex AI)")
-    print("      - ClinicalTrialOrchestrator (workflow coordination)")
+@buffered_output
+def test_rule_based_age_ranges():
+    """Test that the rule-based fallback only reads age ranges as ages"""
+    report("\n📏 Testing Rule-Based Age Range Fallback...")
     
-    print("\n   ✅ A2A Protocol Integration")
-    print("      - Agent discovery and registry")
-    print("      - Standardized message format")
-    print("      - Agent-to-agent communication")
-    print("      - Task tracking and management")
+    from services.vertex_ai import fallback_criterion_analysis
     
-    print("\n   ✅ Function Tools")
-    print("      - Custom Python functions as tools")
-    print("      - Proper docstring documentation")
-    print("      - Type hints and structured returns")
-    
-    print("\n   ✅ Enhanced Logging")
-    print("      - W&B Weave experiment tracking")
-    print("      - Structured workflow logging")
-    print("      - Agent communication tracing")
-    
-    print("\n🔧 TECHNICAL STACK:")
-    print("   - Google ADK 1.6.1+ (Agent Development Kit)")
-    print("   - A2A Protocol 0.1.0 (Agent-to-Agent Communication)")
-    print("   - FastAPI (REST API framework)")
-    print("   - Google Document AI (PDF processing)")
-    print("   - Vertex AI Gemini (LLM reasoning)")
-    print("   - clinicaltrials.gov API (trial data)")
-    print("   - W&B Weave (experiment tracking)")
+    patient = {"age": 50, "allergies": [], "existing_conditions": []}
+    cases = [
+        # (criterion, eligible); the NYHA range must not be compared against the age
+        ("NYHA class 2-3, age ≥ 18", True),
+        ("Stage 2-3 tumor, age 40-65", True),
+        ("Age 40-65", True),
+        ("Adults 18-45 years of age", False)
+    ]
     
-    print("\n🚀 CAPABILITIES:")
-    print("   - Multi-agent workflow orchestration")
-    print("   - Standardized agent communication")
-    print("   - Agent discovery and routing")
-    print("   - Real-time task tracking")
-    print("   - Comprehensive experiment logging")
+    success = True
+    for criterion, expected in cases:
+        result = fallback_criterion_analysis(patient, {"type": "inclusion", "criterion": criterion})
+        if result["eligible"] == expected:
+            report(f"✅ {criterion}: {result['explanation']}")
+        else:
+            report(f"❌ {criterion}: expected eligible={expected}, got {result['eligible']} ({result['explanation']})")
+            success = False
     
-    print("\n📊 ENDPOINTS:")
-    print("   - GET /agents (list all agents)")
-    print("   - GET /agents/{agent_id} (agent details)")
-    print("   - POST /agents/{agent_id}/message (send message)")
-    print("   - POST /workflow/run (run complete workflow)")
-    print("   - GET /tasks/{task_id} (task status)")
-    print("   - POST /upload-pdf-adk (ADK-powered PDF processing)")
+    return success
+
+
+def display_architecture_summary():
+    """Display the Phase 2 architecture summary"""
+    sys.stdout.write(ARCHITECTURE_SUMMARY)
 
 
 async def main():
@@ -218,11 +289,16 @@ async def main():
     print("Google ADK + A2A Protocol for Clinical Trial Matching")
     print("="*60)
     
-    # Test 1: ADK Agents Initialization
+    # Test 1: ADK Agents Initialization (builds the shared agents the other tests reuse)
     adk_success = test_adk_agents_initialization()
     
-    # Test 2: A2A Server Creation
-    a2a_server = test_a2a_server_creation()
+    # Tests 2, 5, 6 and 7 are independent, so they run concurrently in worker threads
+    a2a_server, adk_integration_success, weave_success, age_rules_success = await asyncio.gather(
+        asyncio.to_thread(test_a2a_server_creation),
+        asyncio.to_thread(test_google_adk_integration),
+        asyncio.to_thread(test_weave_logging_integration),
+        asyncio.to_thread(test_rule_based_age_ranges)
+    )
     
     # Test 3: Agent Registry
     registry_success = test_agent_registry(a2a_server) if a2a_server else False
@@ -230,12 +306,6 @@ async def main():
     # Test 4: Agent Communication
     comm_success = await test_agent_communication(a2a_server) if a2a_server else False
     
-    # Test 5: Google ADK Integration
-    adk_integration_success = test_google_adk_integration()
-    
-    # Test 6: Weave Logging Integration
-    weave_success = test_weave_logging_integration()
-    
     # Summary
     print("\n" + "="*60)
     print("📊 TEST RESULTS SUMMARY")
@@ -247,7 +317,8 @@ async def main():
         ("Agent Registry", registry_success),
         ("Agent Communication", comm_success),
         ("Google ADK Integration", adk_integration_success),
-        ("W&B Weave Logging", weave_success)
+        ("W&B Weave Logging", weave_success),
+        ("Rule-Based Age Ranges", age_rules_success)
     ]
     
     passed = sum(1 for _, success in tests if success)
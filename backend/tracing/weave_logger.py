@@ -1,17 +1,298 @@
-import wandb
-import json
+import atexit
+import logging
+import msgspec
+import orjson
+import os
+import queue
+import random
+import reprlib
+import threading
+import time
+import uuid
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, Iterable, List, Optional
 from config import WANDB_API_KEY, WANDB_PROJECT
 
-# Initialize W&B
-wandb.login(key=WANDB_API_KEY)
+# Named log so it isn't shadowed by the WeaveLogger locals below
+log = logging.getLogger(__name__)
+
+# W&B is imported and logged in on first use, so paths that never log skip its startup cost
+_wandb = None
+_wandb_lock = threading.Lock()
+
+# W&B writes are queued and made by one background thread, off the request path
+LOG_QUEUE_SIZE = 50000
+LOG_BATCH_SIZE = 64
+LOG_FLUSH_TIMEOUT_SECONDS = 30
+
+# Optional directory for a local JSON Lines copy of each session's steps, for offline analysis
+LOCAL_LOG_DIR = os.getenv("WEAVE_LOCAL_LOG_DIR")
+if LOCAL_LOG_DIR:
+    os.makedirs(LOCAL_LOG_DIR, exist_ok=True)
+
+# Queued (run, payload) pairs; a _FINISH payload closes the run, a SummaryUpdate
+# payload updates its summary, and _LOCAL pairs carry a (path, line) to append
+# to a local log file instead
+_log_queue: "queue.Queue" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_FINISH = object()
+_LOCAL = object()
+_writer: Optional[threading.Thread] = None
+_writer_lock = threading.Lock()
+
+def load_wandb():
+    """
+    Import wandb and log in, once per process
+    """
+    global _wandb
+    with _wandb_lock:
+        if _wandb is None:
+            import wandb
+            wandb.login(key=WANDB_API_KEY)
+            _wandb = wandb
+    return _wandb
+
+class StepEntry(msgspec.Struct, frozen=True):
+    """One logged workflow step"""
+    step: int
+    step_name: str
+    timestamp: str
+    data: Any
+    metadata: Dict[str, Any]
+
+class SummaryUpdate(msgspec.Struct, frozen=True):
+    """Values to set on a run's summary rather than log as a history row"""
+    values: Dict[str, Any]
+
+class ErrorEntry(msgspec.Struct, frozen=True):
+    """One logged error"""
+    error_type: str
+    error_message: str
+    timestamp: str
+    context: Dict[str, Any]
+
+def json_default(value: Any) -> Any:
+    """
+    Encode values orjson doesn't handle: log entries as their fields, anything else as a string
+    """
+    if isinstance(value, msgspec.Struct):
+        return msgspec.structs.asdict(value)
+    return str(value)
+
+def to_json(value: Any) -> str:
+    """
+    Serialize a log record to a JSON string
+    """
+    return orjson.dumps(value, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+def enqueue_log(run, payload):
+    """
+    Queue a payload for a W&B run (or a local log line) without blocking; dropped if the queue is full
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_write_logs, name="weave-log-writer", daemon=True)
+                _writer.start()
+    try:
+        _log_queue.put_nowait((run, payload))
+    except queue.Full:
+        log.warning("W&B log queue is full; dropping payload")
+
+def _write_logs():
+    """
+    Drain the log queue in batches, merging consecutive payloads for the same run
+    """
+    while True:
+        batch = [_log_queue.get()]
+        while len(batch) < LOG_BATCH_SIZE:
+            try:
+                batch.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+        write_local_lines([payload for run, payload in batch if run is _LOCAL])
+        for run, payload in coalesce_payloads([item for item in batch if item[0] is not _LOCAL]):
+            try:
+                if payload is _FINISH:
+                    run.finish()
+                elif isinstance(payload, SummaryUpdate):
+                    run.summary.update(payload.values)
+                else:
+                    run.log(payload)
+            except Exception as e:
+                log.warning("Failed to write to W&B: %s", e)
+        for _ in batch:
+            _log_queue.task_done()
+
+def write_local_lines(lines: List[tuple]):
+    """
+    Append queued (path, line) pairs to their local log files, one write per file
+    """
+    lines_by_path: Dict[str, List[bytes]] = {}
+    for path, line in lines:
+        lines_by_path.setdefault(path, []).append(line)
+    for path, path_lines in lines_by_path.items():
+        try:
+            with open(path, "ab") as f:
+                f.write(b"".join(path_lines))
+        except OSError as e:
+            log.warning("Failed to write local log %s: %s", path, e)
+
+def coalesce_payloads(batch: List[tuple]) -> List[tuple]:
+    """
+    Merge consecutive payloads for the same run into one log call when their keys don't overlap
+    
+    Only log payloads (dicts) are merged; _FINISH and SummaryUpdate payloads pass through in order.
+    """
+    merged = []
+    for run, payload in batch:
+        if merged and isinstance(payload, dict):
+            last_run, last_payload = merged[-1]
+            if last_run is run and isinstance(last_payload, dict) and last_payload.keys().isdisjoint(payload):
+                last_payload.update(payload)
+                continue
+        merged.append((run, dict(payload) if isinstance(payload, dict) else payload))
+    return merged
+
+def flush_logs(timeout: float = LOG_FLUSH_TIMEOUT_SECONDS) -> bool:
+    """
+    Wait until every queued payload has been written, returning False on timeout
+    """
+    deadline = time.monotonic() + timeout
+    with _log_queue.all_tasks_done:
+        while _log_queue.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            _log_queue.all_tasks_done.wait(remaining)
+    return True
+
+# Don't lose queued logs when the process exits
+atexit.register(flush_logs)
+
+def upload_pdf_metrics(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Metrics for an uploaded PDF
+    """
+    return {"pdf_uploaded": 1, "filename": data.get("filename", "unknown")}
+
+def parsed_pdf_metrics(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Metrics for the patient data parsed from a PDF
+    """
+    metrics = {"pdf_parsed": 1}
+    if "age" in data:
+        metrics["patient_age"] = data["age"]
+    if "allergies" in data:
+        metrics["num_allergies"] = len(data["allergies"])
+    if "existing_conditions" in data:
+        metrics["num_conditions"] = len(data["existing_conditions"])
+    if "lab_results" in data:
+        metrics["num_lab_results"] = len(data["lab_results"])
+    return metrics
+
+def fetched_trials_metrics(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Metrics for the trials fetched from clinicaltrials.gov
+    """
+    return {"num_trials_fetched": data.get("num_trials", 0)}
+
+def eligibility_analysis_metrics(data: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Trial and criteria eligibility rates for an eligibility analysis
+    """
+    if not isinstance(data, list):
+        return {}
+    
+    # Count trials and criteria in one pass over the results
+    eligible_trials = 0
+    total_criteria = 0
+    met_criteria = 0
+    for trial in data:
+        if trial.get("overall_eligible", False):
+            eligible_trials += 1
+        criteria = trial.get("criteria", [])
+        total_criteria += len(criteria)
+        for criterion in criteria:
+            if criterion.get("eligible", False):
+                met_criteria += 1
+    
+    return {
+        "num_trials_analyzed": len(data),
+        "num_eligible_trials": eligible_trials,
+        "eligibility_rate": eligible_trials / len(data) if data else 0,
+        # Criteria analysis
+        "total_criteria_analyzed": total_criteria,
+        "criteria_met": met_criteria,
+        "criteria_success_rate": met_criteria / total_criteria if total_criteria else 0
+    }
+
+# W&B table columns (copied per table, since wandb.Table keeps and can extend its list)
+DEMOGRAPHICS_COLUMNS = ("Field", "Value")
+TRIALS_COLUMNS = ("Trial ID", "Title", "Criteria Count", "Conditions", "Status")
+ELIGIBILITY_COLUMNS = ("Trial ID", "Title", "Eligible", "Criteria Met", "Summary")
+CRITERIA_COLUMNS = ("Trial ID", "Type", "Criterion", "Eligible", "Explanation", "Confidence", "Analyzed By")
+
+# Criteria rows past this many are reservoir-sampled down to it
+MAX_CRITERIA_ROWS = 5000
+
+# Eligible column values shared by every row
+ELIGIBLE_MARK = "✅"
+INELIGIBLE_MARK = "❌"
+
+# Truncating repr for console step output, so large payloads are never stringified in full
+_display_repr = reprlib.Repr()
+_display_repr.maxstring = 200
+_display_repr.maxdict = 5
+_display_repr.maxlist = 10
+
+def sample_rows(rows: Iterable[list], limit: int) -> tuple:
+    """
+    Keep a uniform random sample of at most limit rows (Algorithm R), returning (sample, total row count)
+    """
+    sample = []
+    total = 0
+    for row in rows:
+        if total < limit:
+            sample.append(row)
+        else:
+            j = random.randint(0, total)
+            if j < limit:
+                sample[j] = row
+        total += 1
+    return sample, total
+
+# Metrics logged alongside a workflow step, by step name
+STEP_METRICS = {
+    "upload_pdf": upload_pdf_metrics,
+    "parsed_pdf": parsed_pdf_metrics,
+    "fetched_trials": fetched_trials_metrics,
+    "eligibility_analysis": eligibility_analysis_metrics
+}
 
 class WeaveLogger:
-    def __init__(self, session_name: str = None):
+    def __init__(self, session_name: str = None, lazy: bool = False):
         self.session_name = session_name or f"clinical-trial-session-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        self.run = None
+        self.run_attempted = False
+        self.step_counter = 0
+        # Session names only have second resolution, so the local file gets a unique suffix
+        self.local_log_path = (
+            os.path.join(LOCAL_LOG_DIR, f"{self.session_name}-{uuid.uuid4().hex[:8]}.jsonl")
+            if LOCAL_LOG_DIR else None
+        )
+        # A lazy logger starts its W&B run on the first log call instead
+        if not lazy:
+            self._ensure_run()
+    
+    def _start_run(self):
+        """
+        Start this session's W&B run, or return None if W&B is unavailable
+        """
+        self.run_attempted = True
         try:
-            self.run = wandb.init(
+            return load_wandb().init(
                 project=WANDB_PROJECT,
                 name=self.session_name,
                 reinit=True,
@@ -19,85 +300,72 @@ class WeaveLogger:
                 mode="online"  # Force online mode to avoid hanging
             )
         except Exception as e:
-            print(f"[W&B Weave] Warning: Failed to initialize W&B: {e}")
-            self.run = None
-        self.step_counter = 0
+            log.warning("Failed to initialize W&B: %s", e)
+            return None
+    
+    def _ensure_run(self):
+        """
+        Start this session's W&B run if it hasn't been tried yet, and return it
+        """
+        if not self.run_attempted:
+            self.run = self._start_run()
+        return self.run
+    
+    def _log(self, payload: Dict[str, Any]):
+        """
+        Queue a payload for this session's run (written by the background log writer)
+        """
+        if self._ensure_run() is not None:
+            enqueue_log(self.run, payload)
+    
+    def _update_summary(self, values: Dict[str, Any]):
+        """
+        Queue values for this session's run summary, for one-per-session values that aren't a time series
+        """
+        if self._ensure_run() is not None:
+            enqueue_log(self.run, SummaryUpdate(values=values))
         
-    def log_workflow_step(self, step_name: str, data: Dict[str, Any], metadata: Dict[str, Any] = None):
+    def log_workflow_step(self, step_name: str, data: Dict[str, Any], metadata: Dict[str, Any] = None, timestamp: float = None):
         """
         Log a workflow step with structured data and metadata
+        
+        timestamp is when the step happened (epoch seconds, default now); it is
+        only formatted as ISO 8601 here, when the step is written.
         """
         self.step_counter += 1
         
         # Create structured log entry
-        log_entry = {
-            "step": self.step_counter,
-            "step_name": step_name,
-            "timestamp": datetime.now().isoformat(),
-            "data": data,
-            "metadata": metadata or {}
-        }
+        log_entry = StepEntry(
+            step=self.step_counter,
+            step_name=step_name,
+            timestamp=datetime.fromtimestamp(timestamp or time.time()).isoformat(),
+            data=data,
+            metadata=metadata or {}
+        )
         
-        # Log to W&B with step-specific metrics
-        if self.run:
-            try:
-                wandb.log({
-                    f"step_{self.step_counter}_{step_name}": log_entry,
-                    "current_step": self.step_counter,
-                    "step_name": step_name
-                })
-            except Exception as e:
-                print(f"[W&B Weave] Warning: Failed to log step {step_name}: {e}")
+        # Log to W&B with step-specific metrics in one call (the entry as a JSON string, not a nested dict),
+        # under one stable key so every step lands in the same column
+        entry_json = to_json(log_entry)
+        self._log({
+            "workflow_step": entry_json,
+            "current_step": self.step_counter,
+            "step_name": step_name,
+            **self._step_metrics(step_name, data)
+        })
         
-        # Log step-specific metrics
-        self._log_step_metrics(step_name, data, metadata)
+        if self.local_log_path:
+            enqueue_log(_LOCAL, (self.local_log_path, entry_json.encode() + b"\n"))
         
         print(f"[W&B Weave] Step {self.step_counter} - {step_name}: {self._format_data_for_display(data)}")
     
-    def _log_step_metrics(self, step_name: str, data: Dict[str, Any], metadata: Dict[str, Any]):
+    def _step_metrics(self, step_name: str, data: Dict[str, Any]) -> Dict[str, Any]:
         """
-        Log step-specific metrics and charts
+        Get the step-specific metrics logged with a workflow step
         """
-        metrics = {}
-        
-        if step_name == "upload_pdf":
-            metrics["pdf_uploaded"] = 1
-            metrics["filename"] = data.get("filename", "unknown")
-            
-        elif step_name == "parsed_pdf":
-            metrics["pdf_parsed"] = 1
-            if "age" in data:
-                metrics["patient_age"] = data["age"]
-            if "allergies" in data:
-                metrics["num_allergies"] = len(data["allergies"])
-            if "existing_conditions" in data:
-                metrics["num_conditions"] = len(data["existing_conditions"])
-            if "lab_results" in data:
-                metrics["num_lab_results"] = len(data["lab_results"])
-                
-        elif step_name == "fetched_trials":
-            metrics["num_trials_fetched"] = data.get("num_trials", 0)
-            
-        elif step_name == "eligibility_analysis":
-            if isinstance(data, list):
-                metrics["num_trials_analyzed"] = len(data)
-                eligible_trials = sum(1 for trial in data if trial.get("overall_eligible", False))
-                metrics["num_eligible_trials"] = eligible_trials
-                metrics["eligibility_rate"] = eligible_trials / len(data) if data else 0
-                
-                # Log criteria analysis
-                total_criteria = sum(len(trial.get("criteria", [])) for trial in data)
-                met_criteria = sum(
-                    sum(1 for c in trial.get("criteria", []) if c.get("eligible", False))
-                    for trial in data
-                )
-                metrics["total_criteria_analyzed"] = total_criteria
-                metrics["criteria_met"] = met_criteria
-                metrics["criteria_success_rate"] = met_criteria / total_criteria if total_criteria else 0
-        
-        # Log metrics to W&B
-        if metrics:
-            wandb.log(metrics)
+        step_metrics = STEP_METRICS.get(step_name)
+        if step_metrics is None:
+            return {}
+        return step_metrics(data)
     
     def log_patient_summary(self, patient_data: Dict[str, Any]):
         """
@@ -113,136 +381,133 @@ class WeaveLogger:
             "has_raw_text": bool(patient_data.get("raw_text"))
         }
         
-        try:
-            wandb.log({"patient_summary": summary})
-        except Exception as e:
-            print(f"[W&B Weave] Warning: Failed to log patient summary: {e}")
-            # Try to reinitialize if needed
-            try:
-                if not self.run or not wandb.run:
-                    self.run = wandb.init(
-                        project=WANDB_PROJECT,
-                        name=self.session_name,
-                        reinit=True,
-                        tags=["clinical-trials", "eligibility-analysis", "document-ai", "vertex-ai"],
-                        mode="online"
-                    )
-                    wandb.log({"patient_summary": summary})
-            except Exception as e2:
-                print(f"[W&B Weave] Warning: Failed to reinitialize and log: {e2}")
+        # Try to reinitialize if the run failed to start
+        if self.run is None:
+            self.run = self._start_run()
+        if self.run is None:
+            return
         
         # Create patient demographics table
         demographics_data = [
-            ["Name", str(patient_data.get("name", "Unknown"))],
+            ["Name", patient_data.get("name", "Unknown")],
             ["Age", str(patient_data.get("age", "Unknown"))],
             ["Allergies", ", ".join(patient_data.get("allergies", []))],
             ["Conditions", ", ".join(patient_data.get("existing_conditions", []))],
             ["Lab Results", str(len(patient_data.get("lab_results", {})))]
         ]
         
-        demographics_table = wandb.Table(
-            columns=["Field", "Value"],
+        demographics_table = load_wandb().Table(
+            columns=list(DEMOGRAPHICS_COLUMNS),
             data=demographics_data
         )
         
-        wandb.log({"patient_demographics": demographics_table})
+        self._update_summary({"patient_summary": summary})
+        self._log({"patient_demographics": demographics_table})
     
     def log_trials_summary(self, trials: List[Dict[str, Any]]):
         """
         Log trials summary with structured data
         """
-        if not trials:
+        if not trials or self._ensure_run() is None:
             return
             
-        # Create trials table
-        trials_data = []
-        for trial in trials:
-            trials_data.append([
-                str(trial.get("trial_id", "Unknown")),
-                str(trial.get("title", "Unknown")),
-                str(len(trial.get("eligibility_criteria", []))),
+        # Create trials table (rows built in one comprehension)
+        trials_data = [
+            [
+                trial.get("trial_id", "Unknown"),
+                trial.get("title", "Unknown"),
+                len(trial.get("eligibility_criteria", [])),
                 ", ".join(trial.get("conditions", [])),
-                str(trial.get("status", "Unknown"))
-            ])
+                trial.get("status", "Unknown")
+            ]
+            for trial in trials
+        ]
         
-        trials_table = wandb.Table(
-            columns=["Trial ID", "Title", "Criteria Count", "Conditions", "Status"],
+        trials_table = load_wandb().Table(
+            columns=list(TRIALS_COLUMNS),
             data=trials_data
         )
         
-        wandb.log({"trials_summary": trials_table})
+        # Aggregate criteria counts and conditions in one pass over the trials
+        total_criteria = 0
+        conditions = set()
+        for trial in trials:
+            total_criteria += len(trial.get("eligibility_criteria", ()))
+            conditions.update(trial.get("conditions", ()))
         
-        # Log aggregate metrics
-        wandb.log({
+        # Log the table with its aggregate metrics
+        self._log({
+            "trials_summary": trials_table,
             "total_trials": len(trials),
-            "avg_criteria_per_trial": sum(len(t.get("eligibility_criteria", [])) for t in trials) / len(trials),
-            "unique_conditions": len(set(c for t in trials for c in t.get("conditions", [])))
+            "avg_criteria_per_trial": total_criteria / len(trials),
+            "unique_conditions": len(conditions)
         })
     
     def log_eligibility_results(self, results: List[Dict[str, Any]]):
         """
         Log eligibility analysis results with detailed metrics
         """
-        if not results:
+        if not results or self._ensure_run() is None:
             return
             
-        # Create eligibility results table
-        results_data = []
-        for result in results:
-            eligible_criteria = sum(1 for c in result.get("criteria", []) if c.get("eligible", False))
-            total_criteria = len(result.get("criteria", []))
+        # Create eligibility results table (one row per result, so sized up front)
+        results_data = [None] * len(results)
+        for i, result in enumerate(results):
+            criteria = result.get("criteria", [])
+            eligible_criteria = sum(1 for c in criteria if c.get("eligible", False))
             
-            results_data.append([
-                str(result.get("trial_id", "Unknown")),
-                str(result.get("title", "Unknown")),
-                "✅" if result.get("overall_eligible", False) else "❌",
-                f"{eligible_criteria}/{total_criteria}",
-                str(result.get("eligibility_summary", "No summary"))
-            ])
+            results_data[i] = [
+                result.get("trial_id", "Unknown"),
+                result.get("title", "Unknown"),
+                ELIGIBLE_MARK if result.get("overall_eligible", False) else INELIGIBLE_MARK,
+                f"{eligible_criteria}/{len(criteria)}",
+                result.get("eligibility_summary", "No summary")
+            ]
         
-        results_table = wandb.Table(
-            columns=["Trial ID", "Title", "Eligible", "Criteria Met", "Summary"],
+        results_table = load_wandb().Table(
+            columns=list(ELIGIBILITY_COLUMNS),
             data=results_data
         )
         
-        wandb.log({"eligibility_results": results_table})
-        
-        # Create detailed criteria analysis
-        criteria_data = []
-        for result in results:
-            for criterion in result.get("criteria", []):
-                criteria_data.append([
-                    str(result.get("trial_id", "Unknown")),
-                    str(criterion.get("type", "Unknown")),
-                    str(criterion.get("criterion", "Unknown")),
-                    "✅" if criterion.get("eligible", False) else "❌",
-                    str(criterion.get("explanation", "No explanation")),
-                    str(criterion.get("confidence", "Unknown")),
-                    str(criterion.get("analyzed_by", "Unknown"))
-                ])
+        # Create detailed criteria analysis (one row per criterion of every trial, sampled past MAX_CRITERIA_ROWS)
+        criteria_data, criteria_total = sample_rows((
+            [
+                result.get("trial_id", "Unknown"),
+                criterion.get("type", "Unknown"),
+                criterion.get("criterion", "Unknown"),
+                ELIGIBLE_MARK if criterion.get("eligible", False) else INELIGIBLE_MARK,
+                criterion.get("explanation", "No explanation"),
+                criterion.get("confidence", "Unknown"),
+                criterion.get("analyzed_by", "Unknown")
+            ]
+            for result in results
+            for criterion in result.get("criteria", [])
+        ), MAX_CRITERIA_ROWS)
         
-        criteria_table = wandb.Table(
-            columns=["Trial ID", "Type", "Criterion", "Eligible", "Explanation", "Confidence", "Analyzed By"],
+        criteria_table = load_wandb().Table(
+            columns=list(CRITERIA_COLUMNS),
             data=criteria_data
         )
         
-        wandb.log({"detailed_criteria_analysis": criteria_table})
+        self._log({
+            "eligibility_results": results_table,
+            "detailed_criteria_analysis": criteria_table,
+            "criteria_sampled": criteria_total > MAX_CRITERIA_ROWS,
+            "criteria_total": criteria_total
+        })
     
     def log_error(self, error_type: str, error_message: str, context: Dict[str, Any] = None):
         """
         Log errors with context
         """
-        error_entry = {
-            "error_type": error_type,
-            "error_message": error_message,
-            "timestamp": datetime.now().isoformat(),
-            "context": context or {}
-        }
+        error_entry = ErrorEntry(
+            error_type=error_type,
+            error_message=error_message,
+            timestamp=datetime.now().isoformat(),
+            context=context or {}
+        )
         
-        try:
-            wandb.log({"error": error_entry})
-        except Exception as e:
-            print(f"[W&B Weave] Warning: Failed to log error: {e}")
+        self._log({"error": to_json(error_entry)})
         print(f"[W&B Weave] ERROR - {error_type}: {error_message}")
     
     def finalize_session(self, final_results: Dict[str, Any]):
@@ -253,11 +518,13 @@ class WeaveLogger:
             "session_completed": True,
             "total_steps": self.step_counter,
             "completion_time": datetime.now().isoformat(),
-            "final_results": final_results
+            "final_results": to_json(final_results)
         }
         
-        wandb.log(summary_metrics)
-        wandb.finish()
+        # The run is closed by the log writer once everything queued before it is written
+        self._update_summary(summary_metrics)
+        if self.run is not None:
+            enqueue_log(self.run, _FINISH)
         
         print(f"[W&B Weave] Session {self.session_name} completed with {self.step_counter} steps")
     
@@ -265,11 +532,7 @@ class WeaveLogger:
         """
         Format data for console display
         """
-        if isinstance(data, dict):
-            if len(str(data)) > 200:
-                return f"{str(data)[:200]}..."
-            return str(data)
-        return str(data)
+        return _display_repr.repr(data)
 
 # Global logger instance
 _logger = None
@@ -279,9 +542,9 @@ def get_logger() -> WeaveLogger:
     Get or create a new logger instance for each request
     """
     try:
-        return WeaveLogger()
+        return WeaveLogger(lazy=True)
     except Exception as e:
-        print(f"[W&B Weave] Warning: Failed to create logger: {e}")
+        log.warning("Failed to create logger: %s", e)
         # Create a minimal logger that doesn't crash
         return type('MockLogger', (), {
             'log_workflow_step': lambda self, *args, **kwargs: None,
@@ -292,21 +555,75 @@ def get_logger() -> WeaveLogger:
             'finalize_session': lambda self, *args, **kwargs: None
         })()
 
+class WorkflowTrace:
+    """
+    Logging calls buffered during one workflow and emitted to a single W&B session
+    """
+    
+    def __init__(self):
+        self.entries = []
+        self.logger = None
+    
+    def record(self, method: str, *args, **kwargs):
+        """
+        Buffer a logger method call
+        """
+        self.entries.append((method, args, kwargs))
+    
+    def flush(self) -> WeaveLogger:
+        """
+        Replay buffered calls into this trace's logger and return it
+        """
+        if self.logger is None:
+            self.logger = get_logger()
+        entries, self.entries = self.entries, []
+        for method, args, kwargs in entries:
+            try:
+                getattr(self.logger, method)(*args, **kwargs)
+            except Exception as e:
+                log.warning("Failed to replay %s: %s", method, e)
+        return self.logger
+
+# Trace for the workflow running in the current context (None outside a workflow)
+_current_trace: ContextVar[Optional[WorkflowTrace]] = ContextVar("weave_trace", default=None)
+
+def start_trace():
+    """
+    Start buffering logging calls for the workflow running in the current context
+    
+    Calls already buffered in the context (e.g. the upload that triggered the
+    workflow) are carried over, so they are emitted to the workflow's session.
+    """
+    trace = WorkflowTrace()
+    current = _current_trace.get()
+    if current is not None:
+        trace.entries, current.entries = current.entries, []
+    _current_trace.set(trace)
+
 def log_workflow_step(step_name: str, data: Dict[str, Any], metadata: Dict[str, Any] = None):
     """
     Convenience function for logging workflow steps
     """
+    trace = _current_trace.get()
+    if trace is not None:
+        # Keep the raw clock reading; formatting waits until the trace is flushed
+        trace.record("log_workflow_step", step_name, data, metadata, timestamp=time.time())
+        return
     try:
         logger = get_logger()
         logger.log_workflow_step(step_name, data, metadata)
     except Exception as e:
-        print(f"[W&B Weave] Warning: Logging failed for step {step_name}: {e}")
+        log.warning("Logging failed for step %s: %s", step_name, e)
         # Continue execution even if logging fails
 
 def log_patient_summary(patient_data: Dict[str, Any]):
     """
     Convenience function for logging patient summary
     """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record("log_patient_summary", patient_data)
+        return
     logger = get_logger()
     logger.log_patient_summary(patient_data)
 
@@ -314,6 +631,10 @@ def log_trials_summary(trials: List[Dict[str, Any]]):
     """
     Convenience function for logging trials summary
     """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record("log_trials_summary", trials)
+        return
     logger = get_logger()
     logger.log_trials_summary(trials)
 
@@ -321,19 +642,46 @@ def log_eligibility_results(results: List[Dict[str, Any]]):
     """
     Convenience function for logging eligibility results
     """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.record("log_eligibility_results", results)
+        return
     logger = get_logger()
     logger.log_eligibility_results(results)
 
-def log_error(error_type: str, error_message: str, context: Dict[str, Any] = None):
+def log_error(error_type: str, error_message: str, context: Dict[str, Any] = None, flush_on_error: bool = True):
     """
     Convenience function for logging errors
+    
+    Errors are always logged immediately. Inside a workflow, the steps buffered so
+    far are flushed first (unless flush_on_error is False) so the failure shows up
+    with the trace that led to it.
     """
-    logger = get_logger()
+    trace = _current_trace.get()
+    if trace is not None and flush_on_error:
+        logger = trace.flush()
+    else:
+        logger = get_logger()
     logger.log_error(error_type, error_message, context)
 
-def finalize_session(final_results: Dict[str, Any]):
+def capture_trace() -> Optional[WorkflowTrace]:
+    """
+    Detach the current workflow's trace so it can be finalized from another context
+    """
+    trace = _current_trace.get()
+    _current_trace.set(None)
+    return trace
+
+def finalize_session(final_results: Dict[str, Any], trace: Optional[WorkflowTrace] = None):
     """
     Convenience function for finalizing the session
+    
+    Emits the given trace (or the current workflow's buffered trace) to one W&B session.
     """
-    logger = get_logger()
-    logger.finalize_session(final_results) 
\ No newline at end of file
+    if trace is None:
+        trace = capture_trace()
+    if trace is not None:
+        logger = trace.flush()
+    else:
+        logger = get_logger()
+    logger.finalize_session(final_results)
\ No newline at end of file